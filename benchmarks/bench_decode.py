@@ -0,0 +1,98 @@
+"""Compare gateway datagram decoders on captured traffic.
+
+Run from repository root:
+
+    python benchmarks/bench_decode.py [--number 20000]
+
+Doesn't need Home Assistant: `protocol.py` is loaded straight from file.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import timeit
+
+PROTOCOL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "custom_components", "miio_gateway", "protocol.py")
+
+# Datagrams captured from lumi.gateway.mieu01 running modified miio_client.
+CAPTURED = [
+    b'{"method":"internal.PONG","params":"online"}\x00',
+    b'{"id":12,"result":["ok"]}\x00',
+    b'{"id":13,"result":[32]}\x00',
+    b'{"method":"props","params":{"illumination":318},"id":1291}\x00',
+    b'{"method":"event.motion","model":"lumi.sensor_motion.v2","sid":"lumi.158d0001a2b3c4","params":[]}\x00',
+    b'{"method":"event.keepalive","model":"lumi.sensor_magnet.v2","sid":"lumi.158d0001d4e5f6","params":[]}\x00',
+    b'{"method":"props","model":"lumi.weather.v1","sid":"lumi.158d00027a8b9c","params":{"temperature":2143}}'
+    b'{"method":"props","model":"lumi.weather.v1","sid":"lumi.158d00027a8b9c","params":{"humidity":5512}}'
+    b'{"method":"props","model":"lumi.weather.v1","sid":"lumi.158d00027a8b9c","params":{"pressure":100815}}\x00',
+    b'{"method":"_otc.log","model":"lumi.sensor_wleak.aq1","sid":"lumi.158d0001f0e1d2",'
+    b'"params":{"subdev_zigbee":{"voltage":3025,"lqi":110,"signal":"good"}}}\x00',
+    b'{"method":"_sync.neighborDevInfo","params":{"did":"lumi.158d0001a2b3c4","neighbor":[]}}\x00',
+]
+
+# Payloads the legacy decoder gets wrong.
+CORRUPTED = [
+    # String value containing the frame boundary.
+    b'{"method":"event.click","sid":"lumi.1","params":{"name":"a}{b"}}{"id":5,"result":["ok"]}\x00',
+    # Truncated frame between two valid ones.
+    b'{"id":6,"result":["ok"]}{"method":"props","par{"id":7,"result":["ok"]}\x00',
+]
+
+
+def legacy_decode(data):
+    """Decoder as implemented before protocol.py."""
+    if data[-1] == 0:
+        data = data[:-1]
+    resps = []
+    try:
+        data_arr = "[" + data.decode().replace("}{", "},{") + "]"
+        resps = json.loads(data_arr)
+    except:
+        pass
+    return resps
+
+
+def load_protocol():
+    spec = importlib.util.spec_from_file_location("miio_gateway_protocol", PROTOCOL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench(name, func, number):
+    def run():
+        for data in CAPTURED:
+            func(data)
+    seconds = min(timeit.repeat(run, number=number, repeat=3))
+    per_datagram = seconds / (number * len(CAPTURED)) * 1e6
+    print("%-22s %8.3f s  %6.2f us/datagram" % (name, seconds, per_datagram))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="passes over captured traffic")
+    args = parser.parse_args()
+
+    protocol = load_protocol()
+    print("orjson backend: %s" % ("yes" if protocol.orjson is not None else "no"))
+
+    bench("legacy replace+loads", legacy_decode, args.number)
+    bench("decode_frames", protocol.decode_frames, args.number)
+    if protocol.orjson is not None:
+        orjson = protocol.orjson
+        protocol.orjson = None
+        bench("decode_frames (json)", protocol.decode_frames, args.number)
+        protocol.orjson = orjson
+
+    print()
+    for data in CORRUPTED:
+        messages, errors = protocol.decode_frames(data)
+        print(data)
+        print("  legacy:        %s" % legacy_decode(data))
+        print("  decode_frames: %s, errors: %s" % (messages, errors))
+
+
+if __name__ == "__main__":
+    main()
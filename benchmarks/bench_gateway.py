@@ -0,0 +1,121 @@
+"""End-to-end benchmark of XiaomiGw against the local gateway simulator.
+
+Measures sustained events/second delivered to subscribers of N simulated
+sensors, latency from send to dispatcher callback (entities' own parsing
+and state writes are not included), and request round-trip percentiles. Runs
+offline; needs Home Assistant installed (the component imports it).
+
+Run from repository root:
+
+    python benchmarks/bench_gateway.py --sensors 60 --rate 2000 --duration 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator, sensor_sid  # noqa: E402
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000
+    return "p50 %.3f ms  p90 %.3f ms  p99 %.3f ms  max %.3f ms" % (
+        pick(50), pick(90), pick(99), values[-1] * 1000)
+
+
+async def create_hass(config_dir):
+    from homeassistant.core import HomeAssistant
+    try:
+        return HomeAssistant(config_dir)
+    except TypeError:
+        # Older cores take no arguments.
+        hass = HomeAssistant()
+        hass.config.config_dir = config_dir
+        return hass
+
+
+async def run(args):
+    from custom_components.miio_gateway import (
+        CONF_HOST, CONF_PORT, CONF_PROP_CACHE_TTL, GATEWAY_CONFIG_SCHEMA, XiaomiGw, XiaomiGwEngine)
+
+    simulator = GatewaySimulator(args.sensors, args.loss, args.delay, args.jitter, args.burst, seed=1)
+    host, port = await simulator.async_start()
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = await create_hass(config_dir)
+        engine = XiaomiGwEngine(hass)
+        await engine.async_start()
+        # Round trips must reach the hub, not the property cache.
+        config = GATEWAY_CONFIG_SCHEMA({CONF_HOST: host, CONF_PORT: port, CONF_PROP_CACHE_TTL: 0})
+        gateway = XiaomiGw(hass, engine, config)
+        await gateway.async_start()
+        print("Gateway available: %s" % gateway.is_available())
+
+        latencies = []
+
+        def on_message(model, sid, event, params=None):
+            sent = params.get("sim_sent") if params else None
+            if sent is not None:
+                latencies.append(time.perf_counter() - sent)
+
+        for index in range(args.sensors):
+            # Known like configured sensors, unknown ones take the warning path.
+            gateway.append_known_sid(sensor_sid(index))
+            gateway.append_callback(on_message, sensor_sid(index))
+
+        # Sustained push throughput and dispatcher delivery latency.
+        started = time.perf_counter()
+        pushed = await simulator.async_stream(args.rate, args.duration, stamp=True)
+        await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - started - 0.5
+        print("Pushed %d messages from %d sensors in %.2f s" % (pushed, args.sensors, elapsed))
+        print("Delivered %d (%.0f events/s, %.1f%% lost)" % (
+            len(latencies), len(latencies) / elapsed, 100 * (1 - len(latencies) / pushed) if pushed else 0))
+        print("Dispatcher delivery latency: %s" % percentiles(latencies))
+
+        # Request round trip.
+        rtts = []
+        failed = 0
+        for _ in range(args.requests):
+            sent = time.perf_counter()
+            try:
+                await gateway.async_request({"method": "get_prop", "params": ["gateway_volume"]})
+            except asyncio.TimeoutError:
+                failed = failed + 1
+                continue
+            rtts.append(time.perf_counter() - sent)
+        print("Requests: %d ok, %d failed" % (len(rtts), failed))
+        print("Request RTT: %s" % percentiles(rtts))
+
+        engine.gently_stop()
+        simulator.close()
+        try:
+            await hass.async_stop(force=True)
+        except TypeError:
+            await hass.async_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sensors", type=int, default=60, help="simulated sub-devices")
+    parser.add_argument("--rate", type=float, default=2000, help="pushed messages per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of pushing")
+    parser.add_argument("--burst", type=int, default=1, help="messages per datagram")
+    parser.add_argument("--requests", type=int, default=500, help="get_prop round trips")
+    parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability")
+    parser.add_argument("--delay", type=float, default=0.0, help="simulator reply delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay in seconds")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
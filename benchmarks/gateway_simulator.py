@@ -0,0 +1,224 @@
+"""Local UDP stand-in for lumi.gateway.mieu01 running modified miio_client.
+
+Speaks the same framing as XiaomiGw: answers `internal.PING` with
+`internal.PONG`, replies to requests with id-correlated results, pushes
+`event.*`, `props` and `_otc.log` messages of simulated sub-devices,
+packs bursts of messages into one datagram (`}{` concatenated) and ends
+datagrams with NUL byte. Loss and delay can be scripted.
+
+Standalone:
+
+    python benchmarks/gateway_simulator.py --port 54321 --sensors 60 --rate 50
+
+Then point `miio_gateway` at this host.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+# Simulated sub-device models and messages they push.
+SENSOR_MODELS = [
+    "lumi.sensor_motion.v2",
+    "lumi.sensor_magnet.v2",
+    "lumi.weather.v1",
+    "lumi.sensor_switch.v2",
+]
+
+
+def sensor_sid(index):
+    return "lumi.sim%06d" % index
+
+
+class GatewaySimulator(asyncio.DatagramProtocol):
+    """Simulated gateway. Use `async_start` to bind it."""
+
+    def __init__(self, sensors=10, loss=0.0, delay=0.0, jitter=0.0, burst=1, seed=None):
+        self.sensors = sensors
+        # Probability of dropping an incoming or outgoing datagram.
+        self.loss = loss
+        # Seconds added before every reply/push, plus random jitter.
+        self.delay = delay
+        self.jitter = jitter
+        # Messages packed into a single pushed datagram.
+        self.burst = burst
+
+        self.props = {
+            "gateway_volume": 32,
+            "alarming_volume": 80,
+            "arming": "off",
+            "light": "off",
+            "illumination": 318,
+        }
+
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.requests = []
+
+        self._random = random.Random(seed)
+        self._transport = None
+        self._client = None
+        self._loop = None
+
+    async def async_start(self, host="127.0.0.1", port=0):
+        """Bind simulator and return its (host, port)."""
+        self._loop = asyncio.get_running_loop()
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: self, local_addr=(host, port))
+        return self._transport.get_extra_info("sockname")[:2]
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    """Incoming."""
+
+    def datagram_received(self, data, addr):
+        if self._lost():
+            return
+        self.received = self.received + 1
+        # Like miio_client - talk back to whoever talked to us last.
+        self._client = addr
+        text = data.rstrip(b"\x00").decode()
+        decoder = json.JSONDecoder()
+        pos = 0
+        while pos < len(text):
+            try:
+                msg, pos = decoder.raw_decode(text, pos)
+            except ValueError:
+                return
+            self._handle(msg)
+
+    def _handle(self, msg):
+        method = msg.get("method")
+        self.requests.append(method)
+        if method == "internal.PING":
+            self._send([{"method": "internal.PONG", "params": "online"}])
+            return
+        miio_id = msg.get("id")
+        if miio_id is None:
+            return
+        params = msg.get("params") or []
+        if method == "get_prop":
+            result = [self.props.get(name, "unknown") for name in params]
+        elif method == "get_device_list":
+            result = [{"did": sensor_sid(i), "model": self._model(i)} for i in range(self.sensors)]
+        else:
+            if method.startswith("set_") and params:
+                self.props[method[len("set_"):]] = params[0]
+            result = ["ok"]
+        self._send([{"id": miio_id, "result": result}])
+
+    """Outgoing."""
+
+    def push(self, messages):
+        """Push messages to the client packed into one datagram."""
+        self._send(messages)
+
+    def sensor_message(self, index):
+        """Build a random message of simulated sub-device `index`."""
+        sid = sensor_sid(index)
+        model = self._model(index)
+        kind = self._random.random()
+        if kind < 0.1:
+            return {"method": "event.keepalive", "model": model, "sid": sid, "params": []}
+        if kind < 0.2:
+            return {"method": "_otc.log", "model": model, "sid": sid, "params": {
+                "subdev_zigbee": {"voltage": self._random.randint(2800, 3100), "lqi": self._random.randint(60, 255)}}}
+        if model == "lumi.weather.v1":
+            key = self._random.choice(["temperature", "humidity", "pressure"])
+            return {"method": "props", "model": model, "sid": sid,
+                    "params": {key: self._random.randint(1000, 9000)}}
+        if model == "lumi.sensor_motion.v2":
+            return {"method": "event.motion", "model": model, "sid": sid, "params": []}
+        if model == "lumi.sensor_magnet.v2":
+            return {"method": self._random.choice(["event.open", "event.close"]), "model": model, "sid": sid, "params": []}
+        return {"method": "event.click", "model": model, "sid": sid, "params": []}
+
+    async def async_stream(self, rate, duration, stamp=False):
+        """Push sensor messages at `rate` messages/s for `duration` seconds.
+
+        With `stamp` each message carries `sim_sent` (time.perf_counter) in
+        its params for latency measurement. Returns number of messages pushed.
+        """
+        pushed = 0
+        interval = self.burst / rate
+        end = time.perf_counter() + duration
+        next_push = time.perf_counter()
+        while time.perf_counter() < end:
+            messages = []
+            for _ in range(self.burst):
+                msg = self.sensor_message(self._random.randrange(self.sensors))
+                if stamp:
+                    if not isinstance(msg["params"], dict):
+                        msg["params"] = {}
+                    msg["params"]["sim_sent"] = time.perf_counter()
+                messages.append(msg)
+            self.push(messages)
+            pushed = pushed + len(messages)
+            next_push = next_push + interval
+            await asyncio.sleep(max(0, next_push - time.perf_counter()))
+        return pushed
+
+    def _send(self, messages):
+        if self._client is None or self._transport is None:
+            return
+        data = "".join(json.dumps(msg, separators=(",", ":")) for msg in messages).encode() + b"\x00"
+        delay = self.delay + self._random.random() * self.jitter
+        if delay > 0:
+            self._loop.call_later(delay, self._transmit, data, self._client)
+        else:
+            self._transmit(data, self._client)
+
+    def _transmit(self, data, addr):
+        if self._transport is None or self._lost():
+            return
+        self.sent = self.sent + 1
+        self._transport.sendto(data, addr)
+
+    def _lost(self):
+        if self.loss > 0 and self._random.random() < self.loss:
+            self.dropped = self.dropped + 1
+            return True
+        return False
+
+    def _model(self, index):
+        return SENSOR_MODELS[index % len(SENSOR_MODELS)]
+
+
+async def _run(args):
+    simulator = GatewaySimulator(args.sensors, args.loss, args.delay, args.jitter, args.burst, args.seed)
+    host, port = await simulator.async_start(args.host, args.port)
+    print("Simulated gateway listening on %s:%s" % (host, port))
+    try:
+        while True:
+            if simulator._client is None or args.rate <= 0:
+                await asyncio.sleep(1)
+                continue
+            await simulator.async_stream(args.rate, 1)
+    finally:
+        simulator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated miio gateway.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--sensors", type=int, default=10, help="simulated sub-devices")
+    parser.add_argument("--rate", type=float, default=5, help="pushed messages per second")
+    parser.add_argument("--burst", type=int, default=1, help="messages per datagram")
+    parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability")
+    parser.add_argument("--delay", type=float, default=0.0, help="reply delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay in seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(_run(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
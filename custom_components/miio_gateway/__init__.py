@@ -1,31 +1,81 @@
+import asyncio
+import errno
 import json
 import logging
+import random
 import socket
-from time import sleep
-from threading import Thread
-from multiprocessing import Queue
+from collections import OrderedDict, deque
+from time import monotonic, perf_counter
 from datetime import timedelta
 
 import voluptuous as vol
 
 from homeassistant.const import (
-    CONF_HOST, CONF_MAC, CONF_PORT,
+    CONF_HOST, CONF_MAC, CONF_NAME, CONF_PORT,
     EVENT_HOMEASSISTANT_STOP)
 
+from homeassistant.config_entries import SOURCE_IMPORT
 from homeassistant.core import callback
-from homeassistant.helpers import discovery
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers.event import async_track_time_interval
-from homeassistant.util.dt import utcnow
+from homeassistant.helpers.start import async_at_started
+from homeassistant.util.dt import parse_datetime, utcnow
+
+from .cache import PropertyCache
+from .dedup import DuplicateFilter
+from .discovery import entities_for_model
+from .metrics import GatewayMetrics, NullMetrics
+from .protocol import decode_frames
+from .registry import SubDeviceRegistry
+from .scheduler import ExpiryScheduler
+from .series import PUBLISH_MODES, PUBLISH_RAW
+from .snapshot import XiaomiGwSnapshot, serialize
+from .tracing import FrameTracer, NullTracer
+from .values import decode_values
 
 _LOGGER = logging.getLogger(__name__)
 
 TIME_INTERVAL_PING = timedelta(minutes=1)
+TIMEOUT_PING = timedelta(seconds=6)
+TIMEOUT_INIT_PING = 5.0
+PING_FAILURES = 3
+PING_STATS_WINDOW = 20
+TIMEOUT_REQUEST = timedelta(seconds=3)
+REQUEST_RETRIES = 2
+MAX_PENDING_REQUESTS = 64
+SEND_QUEUE_SIZE = 25
+SEND_INTERVAL = timedelta(0)
+COALESCE_WINDOW = timedelta(milliseconds=100)
+STATE_WRITE_WINDOW = timedelta(0)
+PROP_CACHE_TTL = timedelta(seconds=30)
+MOMENTARY_RESET = timedelta(seconds=15)
+DEDUP_WINDOW = timedelta(milliseconds=500)
+DEFAULT_PUBLISH_INTERVAL = timedelta(seconds=60)
+DEFAULT_PUBLISH_THRESHOLD = 0.5
+RECONNECT_DELAY_MIN = 1.0
+RECONNECT_DELAY_MAX = 300.0
+
+# Socket errors after which the socket is recreated.
+FATAL_SOCKET_ERRORS = {errno.EBADF, errno.ENOTSOCK, errno.ENETDOWN, errno.ENODEV, errno.EADDRNOTAVAIL}
+
+SEND_POLICY_BLOCK = "block"
+SEND_POLICY_DROP_OLDEST = "drop_oldest"
+SEND_POLICY_COALESCE = "coalesce"
+SEND_POLICIES = [SEND_POLICY_BLOCK, SEND_POLICY_DROP_OLDEST, SEND_POLICY_COALESCE]
 
 DOMAIN = "miio_gateway"
 CONF_DATA_DOMAIN = "miio_gateway_config"
+DATA_ENGINE = "miio_gateway_engine"
+DATA_SNAPSHOT = "miio_gateway_snapshot"
 
+PLATFORMS = ["light", "media_player", "binary_sensor", "sensor", "alarm_control_panel"]
+
+CONF_GATEWAYS = "gateways"
+CONF_ENTITY_PREFIX = "entity_prefix"
+# Position of YAML gateway, ties its config entry to it across host changes.
+CONF_YAML_SLOT = "yaml_slot"
 CONF_HOST = "host"
 CONF_PORT = "port"
 CONF_SENSORS = "sensors"
@@ -33,6 +83,30 @@ CONF_SENSOR_SID = "sid"
 CONF_SENSOR_CLASS = "class"
 CONF_SENSOR_NAME = "friendly_name"
 CONF_SENSOR_RESTORE = "restore"
+CONF_SENSOR_RESET = "reset_after"
+CONF_SENSOR_PUBLISH = "publish"
+CONF_SENSOR_PUBLISH_INTERVAL = "publish_interval"
+CONF_SENSOR_PUBLISH_THRESHOLD = "publish_threshold"
+CONF_SENSOR_HISTORY = "history"
+CONF_ILLUMINANCE = "illuminance"
+CONF_PING_INTERVAL = "ping_interval"
+CONF_PING_TIMEOUT = "ping_timeout"
+CONF_PING_FAILURES = "ping_failures"
+CONF_REQUEST_TIMEOUT = "request_timeout"
+CONF_REQUEST_RETRIES = "request_retries"
+CONF_SEND_QUEUE_SIZE = "send_queue_size"
+CONF_SEND_POLICY = "send_policy"
+CONF_SEND_INTERVAL = "send_interval"
+CONF_COALESCE_WINDOW = "coalesce_window"
+CONF_STATE_WRITE_WINDOW = "state_write_window"
+CONF_METRICS = "metrics"
+CONF_TRACE = "trace"
+CONF_DISCOVERY = "discovery"
+CONF_PROP_CACHE_TTL = "prop_cache_ttl"
+CONF_PROP_CACHE_TTLS = "prop_cache_ttls"
+CONF_DEDUP_WINDOW = "dedup_window"
+CONF_DEDUP_EXCLUDE = "dedup_exclude"
+CONF_COUNT = "count"
 
 ATTR_ALIVE = "heartbeat"
 ATTR_VOLTAGE = "voltage"
@@ -44,83 +118,353 @@ EVENT_VALUES = "internal.values"
 EVENT_KEEPALIVE = "event.keepalive"
 EVENT_AVAILABILITY = "event.availability"
 
-SENSORS_CONFIG_SCHEMA = vol.Schema({
+GATEWAY_SID = "miio.gateway"
+GATEWAY_MODEL = "lumi.gateway.mieu01"
+
+METHOD_PING = "internal.PING"
+METHOD_PONG = "internal.PONG"
+METHOD_GET_PROP = "get_prop"
+
+# Methods that are safe to resend when reply is lost.
+IDEMPOTENT_METHODS = ["get_prop", "get_device_list"]
+
+# Last-write-wins methods mapped to the gateway setting they overwrite.
+COALESCE_GROUPS = {
+    "set_rgb": "light",
+    "toggle_light": "light",
+    "set_gateway_volume": "gateway_volume",
+    "set_alarming_volume": "alarming_volume",
+    "set_mute": "mute",
+}
+
+# Properties whose values go stale faster than default cache TTL.
+PROP_CACHE_TTLS = {
+    "illumination": timedelta(seconds=5),
+}
+
+# Events never suppressed as duplicates - quick double clicks are real.
+DEDUP_EXCLUDE = ["event.click", "event.double_click", "event.long_click_press", "event.long_click_release"]
+
+# Events delivered to every subscriber regardless of SID.
+GLOBAL_EVENTS = [EVENT_AVAILABILITY]
+
+# Sent with (gateway, sid, [(platform, device class)]) for discovered devices.
+SIGNAL_DEVICE_DISCOVERED = "miio_gateway_device_discovered"
+
+# How readings of a numeric sensor become its state.
+PUBLISH_SCHEMA = vol.Schema({
+    vol.Optional(CONF_SENSOR_PUBLISH, default=PUBLISH_RAW): vol.In(PUBLISH_MODES),
+    vol.Optional(CONF_SENSOR_PUBLISH_INTERVAL, default=DEFAULT_PUBLISH_INTERVAL): cv.time_period,
+    vol.Optional(CONF_SENSOR_PUBLISH_THRESHOLD, default=DEFAULT_PUBLISH_THRESHOLD): vol.Coerce(float),
+    vol.Optional(CONF_SENSOR_HISTORY, default=0): cv.positive_int,
+})
+
+SENSORS_CONFIG_SCHEMA = PUBLISH_SCHEMA.extend({
     vol.Optional(CONF_SENSOR_SID): cv.string,
     vol.Optional(CONF_SENSOR_CLASS): cv.string,
     vol.Optional(CONF_SENSOR_NAME): cv.string,
     vol.Optional(CONF_SENSOR_RESTORE, default=False): cv.boolean,
+    vol.Optional(CONF_SENSOR_RESET, default=MOMENTARY_RESET): cv.time_period,
+})
+
+GATEWAY_CONFIG_SCHEMA = vol.Schema({
+    vol.Required(CONF_HOST): cv.string,
+    vol.Optional(CONF_NAME): cv.string,
+    vol.Optional(CONF_PORT, default=54321): cv.port,
+    vol.Optional(CONF_SENSORS, default=[]): vol.All(cv.ensure_list, [SENSORS_CONFIG_SCHEMA]),
+    vol.Optional(CONF_PING_INTERVAL, default=TIME_INTERVAL_PING): cv.time_period,
+    vol.Optional(CONF_PING_TIMEOUT, default=TIMEOUT_PING): cv.time_period,
+    vol.Optional(CONF_PING_FAILURES, default=PING_FAILURES): cv.positive_int,
+    vol.Optional(CONF_REQUEST_TIMEOUT, default=TIMEOUT_REQUEST): cv.time_period,
+    vol.Optional(CONF_REQUEST_RETRIES, default=REQUEST_RETRIES): cv.positive_int,
+    vol.Optional(CONF_SEND_QUEUE_SIZE, default=SEND_QUEUE_SIZE): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_SEND_POLICY, default=SEND_POLICY_BLOCK): vol.In(SEND_POLICIES),
+    vol.Optional(CONF_SEND_INTERVAL, default=SEND_INTERVAL): cv.time_period,
+    vol.Optional(CONF_COALESCE_WINDOW, default=COALESCE_WINDOW): cv.time_period,
+    vol.Optional(CONF_STATE_WRITE_WINDOW, default=STATE_WRITE_WINDOW): cv.time_period,
+    vol.Optional(CONF_METRICS, default=False): cv.boolean,
+    vol.Optional(CONF_TRACE, default=0): cv.positive_int,
+    vol.Optional(CONF_DISCOVERY, default=False): cv.boolean,
+    vol.Optional(CONF_PROP_CACHE_TTL, default=PROP_CACHE_TTL): cv.time_period,
+    vol.Optional(CONF_PROP_CACHE_TTLS, default={}): {cv.string: cv.time_period},
+    vol.Optional(CONF_DEDUP_WINDOW, default=DEDUP_WINDOW): cv.time_period,
+    vol.Optional(CONF_ILLUMINANCE, default={}): PUBLISH_SCHEMA,
+    vol.Optional(CONF_DEDUP_EXCLUDE, default=DEDUP_EXCLUDE): vol.All(cv.ensure_list, [cv.string]),
 })
 
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Required(CONF_HOST): cv.string,
-        vol.Optional(CONF_PORT, default=54321): cv.port,
-        vol.Optional(CONF_SENSORS, default={}): vol.Any(cv.ensure_list, [SENSORS_CONFIG_SCHEMA]),
-    })
+    # Either single gateway or list of them.
+    DOMAIN: vol.Any(GATEWAY_CONFIG_SCHEMA, vol.Schema({
+        vol.Required(CONF_GATEWAYS): vol.All(cv.ensure_list, [GATEWAY_CONFIG_SCHEMA]),
+    }))
 }, extra=vol.ALLOW_EXTRA)
 
 SERVICE_JOIN_ZIGBEE = "join_zigbee"
-SERVICE_SCHEMA = vol.Schema({})
-
-def setup(hass, config):
-    """Setup gateway from config."""
-    _LOGGER.info("Starting gateway setup...")
+SERVICE_DUMP_METRICS = "dump_metrics"
+SERVICE_DUMP_TRACE = "dump_trace"
+SERVICE_LIST_UNCONFIGURED = "list_unconfigured"
+SERVICE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_HOST): cv.string,
+})
+SERVICE_DUMP_TRACE_SCHEMA = SERVICE_SCHEMA.extend({
+    vol.Optional(CONF_COUNT, default=50): cv.positive_int,
+})
 
-    # Gateway starts it's action on object init.
-    gateway = XiaomiGw(hass, config[DOMAIN][CONF_HOST], config[DOMAIN][CONF_PORT])
+EVENT_METRICS = "miio_gateway.metrics"
+EVENT_TRACE = "miio_gateway.trace"
+EVENT_UNCONFIGURED = "miio_gateway.unconfigured"
 
-    # Gentle stop on HASS stop.
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, gateway.gently_stop)
+async def async_setup(hass, config):
+    """Import gateways configured in YAML as config entries and register services."""
+    hass.data.setdefault(DOMAIN, {})
+    hass.data.setdefault(CONF_DATA_DOMAIN, {})
 
-    # Share the config to platform's components.
-    hass.data[DOMAIN] = gateway
-    hass.data[CONF_DATA_DOMAIN] = config[DOMAIN].get(CONF_SENSORS)
+    # Last known values of all devices, read once for warm start.
+    snapshot = hass.data[DATA_SNAPSHOT] = XiaomiGwSnapshot(hass)
+    await snapshot.async_start()
 
-    # Load components.
-    for component in ["light", "media_player", "binary_sensor", "sensor", "alarm_control_panel"]:
-        discovery.load_platform(hass, component, DOMAIN, {}, config)
+    if DOMAIN in config:
+        gateways_config = config[DOMAIN].get(CONF_GATEWAYS, [config[DOMAIN]])
+        hass.async_create_task(_async_import(hass, gateways_config))
 
     # Zigbee join HASS service helper.
     def join_zigbee_service_handler(service):
-        gateway = hass.data[DOMAIN]
-        gateway.send_to_hub({ "method": "start_zigbee_join" })
-    hass.services.register(
+        host = service.data.get(CONF_HOST)
+        for gateway in list(hass.data[DOMAIN].values()):
+            if host is None or gateway.host == host:
+                gateway.send_to_hub({ "method": "start_zigbee_join" })
+    hass.services.async_register(
         DOMAIN, SERVICE_JOIN_ZIGBEE, join_zigbee_service_handler,
         schema=SERVICE_SCHEMA)
 
+    # Metrics snapshot HASS service helper.
+    @callback
+    def dump_metrics_service_handler(service):
+        host = service.data.get(CONF_HOST)
+        for gateway in list(hass.data[DOMAIN].values()):
+            if host is None or gateway.host == host:
+                snapshot = gateway.metrics.snapshot()
+                _LOGGER.info("Metrics of %s: %s", gateway.host, json.dumps(snapshot))
+                hass.bus.fire(EVENT_METRICS, {CONF_HOST: gateway.host, CONF_METRICS: snapshot})
+    hass.services.async_register(
+        DOMAIN, SERVICE_DUMP_METRICS, dump_metrics_service_handler,
+        schema=SERVICE_SCHEMA)
+
+    # Frame trace HASS service helper.
+    @callback
+    def dump_trace_service_handler(service):
+        host = service.data.get(CONF_HOST)
+        for gateway in list(hass.data[DOMAIN].values()):
+            if host is None or gateway.host == host:
+                frames = gateway.tracer.last(service.data[CONF_COUNT])
+                for frame in frames:
+                    _LOGGER.info("Trace of %s: %s", gateway.host, frame)
+                hass.bus.fire(EVENT_TRACE, {CONF_HOST: gateway.host, "frames": frames})
+    hass.services.async_register(
+        DOMAIN, SERVICE_DUMP_TRACE, dump_trace_service_handler,
+        schema=SERVICE_DUMP_TRACE_SCHEMA)
+
+    # Discovered but unconfigured devices HASS service helper.
+    @callback
+    def list_unconfigured_service_handler(service):
+        host = service.data.get(CONF_HOST)
+        for gateway in list(hass.data[DOMAIN].values()):
+            if host is None or gateway.host == host:
+                devices = [device.as_dict() for device in gateway.registry.unconfigured()]
+                for device in devices:
+                    _LOGGER.info("Unconfigured device of %s: %s", gateway.host, device)
+                hass.bus.fire(EVENT_UNCONFIGURED, {CONF_HOST: gateway.host, "devices": devices})
+    hass.services.async_register(
+        DOMAIN, SERVICE_LIST_UNCONFIGURED, list_unconfigured_service_handler,
+        schema=SERVICE_SCHEMA)
+
+    return True
+
+async def _async_import(hass, gateways_config):
+    """Import YAML gateways one by one, so each sees prefixes taken by previous ones."""
+    for index, gateway_config in enumerate(gateways_config):
+        data = _entry_data(gateway_config)
+        data[CONF_YAML_SLOT] = index
+        await hass.config_entries.flow.async_init(
+            DOMAIN, context={"source": SOURCE_IMPORT}, data=data)
+
+async def async_setup_entry(hass, entry):
+    """Setup gateway of config entry.
+
+    Returns without waiting for gateway; it's probed in background and its
+    entities stay unavailable until the first reply.
+    """
+    _LOGGER.info("Starting gateway setup...")
+
+    data = dict(entry.data)
+    entity_prefix = data.pop(CONF_ENTITY_PREFIX, "")
+    data.pop(CONF_YAML_SLOT, None)
+    data.update(entry.options)
+    gateway_config = GATEWAY_CONFIG_SCHEMA(data)
+
+    # One socket serves all gateways.
+    engine = hass.data.get(DATA_ENGINE)
+    if engine is None:
+        engine = hass.data[DATA_ENGINE] = XiaomiGwEngine(hass)
+        engine.stop_with_hass()
+    await engine.async_start()
+
+    # Share gateway and its config to platform's components.
+    gateway = XiaomiGw(hass, engine, gateway_config, entity_prefix)
+    hass.data[DOMAIN][entry.entry_id] = gateway
+    hass.data[CONF_DATA_DOMAIN][gateway.unique_id()] = gateway_config.get(CONF_SENSORS)
+    hass.data[DATA_SNAPSHOT].restore_gateway(gateway)
+    gateway.async_schedule_start()
+
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+    entry.async_on_unload(entry.add_update_listener(_async_reload_entry))
+
+    # Discover devices once platforms are ready to add their entities.
+    if gateway.discovery:
+        @callback
+        def start_discovery(hass):
+            hass.async_create_task(gateway.async_start_discovery())
+        entry.async_on_unload(async_at_started(hass, start_discovery))
+
     return True
 
+async def async_unload_entry(hass, entry):
+    """Remove entities of config entry and stop its gateway."""
+    if not await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
+        return False
+
+    gateway = hass.data[DOMAIN].pop(entry.entry_id)
+    hass.data[CONF_DATA_DOMAIN].pop(gateway.unique_id(), None)
+    hass.data[DATA_SNAPSHOT].forget_gateway(gateway)
+    gateway.gently_stop()
+
+    if not hass.data[DOMAIN]:
+        # Last gateway gone, release the socket.
+        hass.data.pop(DATA_ENGINE).gently_stop()
+    return True
+
+async def _async_reload_entry(hass, entry):
+    """Apply changed options."""
+    await hass.config_entries.async_reload(entry.entry_id)
+
+def _entry_data(config):
+    """Convert validated gateway config to JSON serializable entry data."""
+    data = {}
+    for key, value in config.items():
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        elif isinstance(value, dict):
+            value = _entry_data(value)
+        elif isinstance(value, list):
+            value = [_entry_data(item) if isinstance(item, dict) else item for item in value]
+        data[key] = value
+    return data
+
 class XiaomiGw:
-    """Gateway socket and communication layer."""
+    """Gateway socket and communication layer. Must be created in event loop."""
 
-    def __init__(self, hass, host, port):
+    def __init__(self, hass, engine, config, entity_prefix=""):
         self.hass = hass
 
-        self._host = host
-        self._port = port
+        self.host = config[CONF_HOST]
+        self._port = config[CONF_PORT]
+        self._addr = (self.host, self._port)
+        # Prepended to IDs of entities so gateways can't clash.
+        self.entity_prefix = entity_prefix
 
-        self._socket = None
-        self._thread = None
-        self._thread_alive = True
+        self._engine = engine
+        self._first_reply = None
+        # Shared expiry of momentary entity states.
+        self.scheduler = engine.scheduler
+
+        self.metrics = GatewayMetrics() if config[CONF_METRICS] else NullMetrics()
+        self.tracer = FrameTracer(config[CONF_TRACE]) if config[CONF_TRACE] else NullTracer()
+
+        # Seconds within which entity state writes are merged.
+        self.state_write_window = config[CONF_STATE_WRITE_WINDOW].total_seconds()
+        # Publishing of gateway's own illuminance sensor.
+        self.illuminance_options = config[CONF_ILLUMINANCE]
+
+        self._send_policy = config[CONF_SEND_POLICY]
+        self._send_queue = XiaomiGwSendQueue(
+            hass.loop, self._send_datagram, config[CONF_SEND_QUEUE_SIZE], self._send_policy,
+            config[CONF_SEND_INTERVAL].total_seconds())
+        self._coalescer = XiaomiGwCoalescer(
+            hass.loop, self._enqueue_coalesced, config[CONF_COALESCE_WINDOW].total_seconds())
 
-        self._send_queue = Queue(maxsize=25)
         self._miio_id = 0
 
-        self._callbacks = []
-        self._result_callbacks = {}
+        self._dispatcher = engine.dispatcher
+
+        # Incoming method routing: exact names, "prefix." names and memo of
+        # resolved lookups so every method costs one dict lookup.
+        self._method_handlers = {
+            "_sync.neighborDevInfo": self._handle_ignored,
+            "_otc.log": self._handle_metadata,
+            "props": self._handle_values,
+        }
+        self._prefix_handlers = {
+            "internal.": self._handle_internal,
+            "event.": self._handle_event,
+        }
+        self._resolved_handlers = {}
+
+        # Drops event.* and props messages repeated by the hub.
+        self._duplicates = DuplicateFilter(
+            config[CONF_DEDUP_WINDOW].total_seconds(), config[CONF_DEDUP_EXCLUDE])
+
+        # miio id -> future of request awaiting its result, oldest first.
+        self._pending_requests = OrderedDict()
+        self._request_timeout = config[CONF_REQUEST_TIMEOUT].total_seconds()
+        self._request_retries = config[CONF_REQUEST_RETRIES]
+
+        # Gateway properties entities read on start and reconnect, fetched
+        # by one shared sync task.
+        self._sync_props = []
+        self._sync_task = None
+        # Properties read by sync task; None while it still gathers callers.
+        self._sync_task_props = ()
+        # Background start, cancelled if gateway stops before it's done.
+        self._start_task = None
+        # Cleared once hub refuses multi-property get_prop.
+        self._multi_get_prop = True
+
+        # Values from get_prop results and pushed props.
+        ttls = dict(PROP_CACHE_TTLS, **config[CONF_PROP_CACHE_TTLS])
+        self.prop_cache = PropertyCache(
+            config[CONF_PROP_CACHE_TTL].total_seconds(),
+            {prop: ttl.total_seconds() for prop, ttl in ttls.items()})
 
         self._available = None
         self._availability_pinger = None
-        self._pings_sent = 0
-
-        self._known_sids = []
-        self._known_sids.append("miio.gateway") # Append self.
+        self._ping_interval = config[CONF_PING_INTERVAL]
+        self._ping_timeout = config[CONF_PING_TIMEOUT].total_seconds()
+        self._ping_failures_limit = config[CONF_PING_FAILURES]
+        self._ping_failures = 0
+        self._ping_waiter = None
+        # Rolling window of ping RTTs in seconds, None for lost pings.
+        self._ping_rtts = deque(maxlen=PING_STATS_WINDOW)
+
+        for key in ("depth", "max_depth", "sent", "dropped", "coalesced", "wait_avg_ms", "wait_max_ms"):
+            self.metrics.add_gauge("send_queue_" + key, lambda key=key: self._send_queue.stats()[key])
+        self.metrics.add_gauge("coalesced_in_window", lambda: self._coalescer.coalesced)
+        self.metrics.add_gauge("pending_requests", lambda: len(self._pending_requests))
+        self.metrics.add_gauge("ping_rtt_ms", lambda: self.ping_stats()["rtt"])
+        self.metrics.add_gauge("ping_loss", lambda: self.ping_stats()["loss"])
+        self.metrics.add_gauge("prop_cache_hits", lambda: self.prop_cache.hits)
+        self.metrics.add_gauge("prop_cache_misses", lambda: self.prop_cache.misses)
+        self.metrics.add_gauge("duplicates_suppressed", lambda: self._duplicates.suppressed)
+
+        # Sub-devices by SID, from config and observed traffic.
+        self.registry = SubDeviceRegistry()
+        self.registry.configure(GATEWAY_SID) # Append self.
+
+        # Create entities for unconfigured devices of known models.
+        self.discovery = config[CONF_DISCOVERY]
+        self._discovery_started = False
 
         import hashlib, base64
-        self._unique_id = base64.urlsafe_b64encode(hashlib.sha1((self._host + ":" + str(self._port)).encode("utf-8")).digest())[:10].decode("utf-8")
-
-        self._create_socket()
-        self._init_listener()
+        self._unique_id = base64.urlsafe_b64encode(hashlib.sha1((self.host + ":" + str(self._port)).encode("utf-8")).digest())[:10].decode("utf-8")
 
     """Public."""
 
@@ -132,128 +476,405 @@ class XiaomiGw:
         """Return availability state."""
         return self._available
 
+    def ping_stats(self):
+        """Return average RTT (ms) and loss ratio over recent pings."""
+        rtts = [rtt for rtt in self._ping_rtts if rtt is not None]
+        return {
+            "rtt": round(1000 * sum(rtts) / len(rtts), 1) if rtts else None,
+            "loss": round(1 - len(rtts) / len(self._ping_rtts), 2) if self._ping_rtts else None,
+        }
+
+    async def async_start(self):
+        """Resolve gateway, probe it with first ping and start tracking availability."""
+        await self._async_resolve_address()
+        await self._async_probe()
+        # We can start listener for future actions.
+        self._start_listening()
+
+    @callback
+    def async_schedule_start(self):
+        """Start gateway without blocking setup."""
+        self._start_task = self.hass.async_create_task(self.async_start())
+        self._start_task.add_done_callback(self._start_done)
+
+    @callback
+    def _start_done(self, task):
+        if self._start_task is task:
+            self._start_task = None
+
+    @callback
     def gently_stop(self, event=None):
-        """Stops listener and closes socket."""
+        """Stops listener, drops queued work and detaches from shared socket."""
+        if self._start_task is not None:
+            # Still resolving or probing; it would register and listen again.
+            self._start_task.cancel()
+            self._start_task = None
         self._stop_listening()
-        self._close_socket()
+        self._engine.unregister(self._addr)
+        self._send_queue.close()
+        self._coalescer.close()
+        if self._ping_waiter is not None and not self._ping_waiter.done():
+            self._ping_waiter.cancel()
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        for future in self._pending_requests.values():
+            if not future.done():
+                future.cancel()
+        self._pending_requests.clear()
 
     def send_to_hub(self, data, callback=None):
-        """Send data to hub."""
-        miio_id, data = self._miio_msg_encode(data)
-        if callback is not None:
-            _LOGGER.info("Adding callback for call ID: " + str(miio_id))
-            self._result_callbacks[miio_id] = callback
-        self._send_queue.put(data)
+        """Send data to hub. Safe to call from any thread.
 
-    def append_callback(self, callback):
-        self._callbacks.append(callback)
+        If `callback` is given it's called with single-value result once
+        the hub replies.
+        """
+        self.metrics.inc("commands")
+        if callback is not None:
+            self.hass.loop.call_soon_threadsafe(
+                self.hass.async_create_task, self._async_request_callback(data, callback))
+            return
+        method = data.get("method")
+        miio_id, data = self._miio_msg_encode(data)
+        future = asyncio.run_coroutine_threadsafe(
+            self._async_send(method, data), self.hass.loop)
+        if self._send_policy == SEND_POLICY_BLOCK and not self._in_loop():
+            # Backpressure on worker threads only, never on the loop.
+            future.result()
+
+    def prop_cache_stats(self):
+        """Return property cache size and hit/miss counts."""
+        return self.prop_cache.stats()
+
+    async def async_request(self, data, timeout=None):
+        """Send request to hub and return its raw result.
+
+        Fresh cached properties of `get_prop` are served without asking the
+        hub. Idempotent requests are retried on timeout. Raises
+        asyncio.TimeoutError when no reply came or XiaomiGwRequestError when
+        the hub returned error.
+        """
+        method = data.get("method")
+        props = data.get("params")
+        if method != METHOD_GET_PROP or not isinstance(props, list):
+            self._invalidate_props(method)
+            return await self._async_request(data, timeout)
+
+        values = {}
+        missing = []
+        for prop in props:
+            found, value = self.prop_cache.get(GATEWAY_SID, prop)
+            if found:
+                values[prop] = value
+            else:
+                missing.append(prop)
+        if missing:
+            result = await self._async_request(dict(data, params=missing), timeout)
+            if not isinstance(result, list) or len(result) != len(missing):
+                # Can't tell which value is which, pass it as is.
+                return result
+            fetched = dict(zip(missing, result))
+            self.prop_cache.update(GATEWAY_SID, fetched)
+            values.update(fetched)
+        return [values[prop] for prop in props]
+
+    async def _async_request(self, data, timeout):
+        """Send request to hub and await its result."""
+        if timeout is None:
+            timeout = self._request_timeout
+        attempts = 1
+        if data.get("method") in IDEMPOTENT_METHODS:
+            attempts = attempts + self._request_retries
+
+        for attempt in range(attempts):
+            miio_id, payload = self._miio_msg_encode(data)
+            future = self.hass.loop.create_future()
+            self._add_pending_request(miio_id, future)
+            sent = perf_counter()
+            try:
+                await self._send_queue.async_put(data.get("method"), payload)
+                result = await asyncio.wait_for(future, timeout)
+                self.metrics.observe("request", perf_counter() - sent)
+                return result
+            except asyncio.TimeoutError:
+                self.metrics.inc("request_timeouts")
+                _LOGGER.debug("Request %s timed out (attempt %s of %s)", miio_id, attempt + 1, attempts)
+            finally:
+                self._pending_requests.pop(miio_id, None)
+
+        raise asyncio.TimeoutError("No reply for " + str(data.get("method")))
+
+    async def async_get_prop(self, prop):
+        """Read single gateway property."""
+        result = await self.async_request({"method": METHOD_GET_PROP, "params": [prop]})
+        return self._result_value(result)
+
+    def register_sync_props(self, props):
+        """Announce gateway properties an entity will read by `async_sync_props`."""
+        for prop in props:
+            if prop not in self._sync_props:
+                self._sync_props.append(prop)
+
+    async def async_sync_props(self, props):
+        """Return dict of gateway properties read by sync stage.
+
+        All registered properties are read in one multi-property
+        `get_prop`; concurrent and later callers share its result until
+        gateway reconnects. Raises like `async_request`.
+        """
+        self.register_sync_props(props)
+        task = self._sync_task
+        if (task is None
+                or (self._sync_task_props is not None
+                    and any(prop not in self._sync_task_props for prop in props))
+                or (task.done() and (task.cancelled() or task.exception() is not None))):
+            self._sync_task_props = None
+            task = self._sync_task = self.hass.async_create_task(self._async_sync())
+        return await asyncio.shield(task)
+
+    async def _async_sync(self):
+        # Let entities updating in the same loop iteration join this read.
+        await asyncio.sleep(0)
+        self._sync_task_props = tuple(self._sync_props)
+        return await self._async_read_props(self._sync_task_props)
+
+    def append_callback(self, callback, sid=None, events=None, keys=None):
+        """Subscribe to data of given SID. Returns unsubscribe function."""
+        return self._dispatcher.subscribe(callback, self._unique_id, sid, events, keys)
+
+    def register_method_handler(self, method, handler, prefix=False):
+        """Route incoming `method` (or all methods starting with `method`
+        when `prefix` is set) to `handler(model, sid, method, params)`.
+        """
+        handlers = self._prefix_handlers if prefix else self._method_handlers
+        handlers[method] = handler
+        self._resolved_handlers.clear()
+
+        def unregister():
+            if handlers.get(method) is handler:
+                del handlers[method]
+                self._resolved_handlers.clear()
+
+        return unregister
 
     def append_known_sid(self, sid):
-        self._known_sids.append(sid)
+        self.registry.configure(sid)
 
-    """Private."""
+    async def async_start_discovery(self):
+        """Learn devices from hub's device list and announce unconfigured ones.
 
-    def _create_socket(self):
-        """Create connection socket."""
-        _LOGGER.debug("Creating socket...")
-        self._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        Devices heard of later are announced as soon as they send anything.
+        """
+        try:
+            devices = await self.async_request({"method": "get_device_list"})
+        except (asyncio.TimeoutError, XiaomiGwRequestError) as e:
+            _LOGGER.warning("Can't read device list of %s: %s", self.host, e)
+            devices = []
+        if not isinstance(devices, list):
+            _LOGGER.warning("Unexpected device list of %s: %s", self.host, devices)
+            devices = []
+        for entry in devices:
+            if isinstance(entry, dict) and entry.get("did"):
+                self.registry.seen(entry["did"], entry.get("model"))
+
+        self._discovery_started = True
+        for device in list(self.registry):
+            if not device.configured and not device.discovered:
+                self._discover(device)
 
-    def _close_socket(self, event=None):
-        """Close connection socket."""
-        if self._socket is not None:
-            _LOGGER.debug("Closing socket...")
-            self._socket.close()
-            self._socket = None
+    """Private."""
+
+    async def _async_resolve_address(self):
+        """Resolve gateway host so replies can be matched by source address."""
+        try:
+            address = await self.hass.async_add_executor_job(socket.gethostbyname, self.host)
+            self._addr = (address, self._port)
+        except OSError as e:
+            # Error: gateway configuration may be wrong.
+            _LOGGER.error("Can't resolve gateway host %s!", self.host)
+            _LOGGER.error(e)
+        self._engine.register(self._addr, self)
 
-    def _init_listener(self):
-        """Initialize socket connection with first ping. Set availability accordingly."""
+    async def _async_probe(self):
+        """Send first ping and wait for any reply."""
+        self._first_reply = self.hass.loop.create_future()
+        miio_id, ping = self._miio_msg_encode({"method": METHOD_PING})
+        self._send_datagram(ping)
         try:
-            # Send ping (w/o queue).
-            miio_id, ping = self._miio_msg_encode({"method": "internal.PING"})
-            self._socket.settimeout(0.1)
-            self._socket.sendto(ping, (self._host, self._port))
-            # Wait for response.
-            self._socket.settimeout(5.0)
-            res = self._socket.recvfrom(1480)[0]
-            # If didn't timeouted - gateway is available.
-            self._set_availability(True)
-        except socket.timeout:
+            # Reply itself marks gateway as available.
+            await asyncio.wait_for(self._first_reply, TIMEOUT_INIT_PING)
+        except asyncio.TimeoutError:
             # If timeouted – gateway is unavailable.
             self._set_availability(False)
-        except (TypeError, socket.error) as e:
+        except OSError as e:
             # Error: gateway configuration may be wrong.
             _LOGGER.error("Socket error! Your gateway configuration may be wrong!")
             _LOGGER.error(e)
             self._set_availability(False)
+        finally:
+            self._first_reply = None
 
-        # We can start listener for future actions.
-        if self._available is not None:
-            # We have gateway initial state - now we can run loop thread that does it all.
-            self._start_listening()
-
+    @callback
     def _start_listening(self):
-        """Create thread for loop."""
-        _LOGGER.debug("Starting thread...")
-        self._thread = Thread(target=self._run_socket_thread, args=())
-        #self._thread.daemon = True
-        self._thread.start()
+        """Start tracking availability. Receiving is driven by the protocol."""
         _LOGGER.debug("Starting availability tracker...")
         self._track_availability()
 
     def _stop_listening(self):
-        """Remove loop thread."""
-        _LOGGER.debug("Exiting thread...")
-        self._thread_alive = False
-        self._thread.join()
+        """Stop tracking availability."""
+        _LOGGER.debug("Stopping availability tracker...")
+        if self._availability_pinger is not None:
+            self._availability_pinger()
+            self._availability_pinger = None
 
-    def _run_socket_thread(self):
-        """Thread loop task."""
-        _LOGGER.debug("Starting listener thread...")
+    @callback
+    def _send_datagram(self, data):
+        """Send encoded data to the gateway. Must run in the event loop."""
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Sending data: %s", data)
+        if self.tracer.enabled:
+            self.tracer.sent(json.loads(data), len(data))
+        metrics = self.metrics
+        if metrics.enabled:
+            metrics.inc("packets_out")
+            metrics.inc("bytes_out", len(data))
+        self._engine.sendto(data, self._addr)
 
-        while self._thread_alive:
+    @callback
+    def _datagram_received(self, data):
+        """Handle datagram received from the gateway."""
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received data: %s", data)
 
-            if self._socket is None:
-                _LOGGER.error("No socket in listener!")
-                self.create_socket()
-                continue
+        metrics = self.metrics
+        if metrics.enabled:
+            started = perf_counter()
+            metrics.inc("packets_in")
+            metrics.inc("bytes_in", len(data))
 
-            try:
-                while not self._send_queue.empty():
-                    self._socket.settimeout(0.1)
-                    data = self._send_queue.get()
-                    _LOGGER.debug("Sending data:")
-                    _LOGGER.debug(data)
-                    self._socket.sendto(data, (self._host, self._port))
+        if self._first_reply is not None and not self._first_reply.done():
+            self._first_reply.set_result(True)
 
-                self._socket.settimeout(1)
-                data = self._socket.recvfrom(1480)[0] # Will timeout on no data.
+        # We got here in code = we have communication with gateway.
+        self._set_availability(True)
 
-                _LOGGER.debug("Received data:")
-                _LOGGER.debug(data)
+        # Get all messages from response data.
+        resps = self._miio_msg_decode(data)
 
-                # We got here in code = we have communication with gateway.
-                self._set_availability(True)
+        if self.tracer.enabled:
+            for res in resps:
+                self.tracer.received(res, len(data))
 
-                # Get all messages from response data.
-                resps = self._miio_msg_decode(data)
+        # Parse all messages in response.
+        self._parse_received_resps(resps)
 
-                # Parse all messages in response.
-                self._parse_received_resps(resps)
+        if metrics.enabled:
+            metrics.inc("messages_in", len(resps))
+            metrics.observe("dispatch", perf_counter() - started)
 
-            except socket.timeout:
-                pass
-            except socket.error as e:
-                _LOGGER.error("Socket error!")
-                _LOGGER.error(e)
+    @callback
+    def _transport_error(self, exc):
+        """Handle error reported by the datagram transport."""
+        if self._first_reply is not None and not self._first_reply.done():
+            self._first_reply.set_exception(exc)
+            return
+        _LOGGER.error("Socket error! %s", exc)
+
+    @callback
+    def _transport_reconnected(self):
+        """Socket was recreated, check gateway and re-sync its state."""
+        self.metrics.inc("reconnects")
+        self.hass.async_create_task(self._async_resync())
+
+    async def _async_resync(self):
+        """Ping gateway and make entities read fresh state."""
+        await self._async_ping()
+        if self._available:
+            self._sync_task = None
+            self.prop_cache.clear()
+            self._dispatcher.dispatch(self._unique_id, None, None, EVENT_AVAILABILITY)
+
+    async def _async_request_callback(self, data, callback):
+        """Await request and pass its result to legacy callback."""
+        try:
+            result = await self.async_request(data)
+        except (asyncio.TimeoutError, XiaomiGwRequestError) as e:
+            _LOGGER.warning("Request %s failed: %s", data.get("method"), e)
+            return
+        callback(self._result_value(result))
+
+    async def _async_send(self, method, payload):
+        """Pass fire-and-forget command through coalescing to send queue."""
+        self._invalidate_props(method)
+        if self._coalescer.submit(method, payload):
+            return
+        await self._send_queue.async_put(method, payload, True)
+
+    @callback
+    def _enqueue_coalesced(self, method, payload):
+        self.hass.async_create_task(self._send_queue.async_put(method, payload, True))
+
+    def _in_loop(self):
+        """Return True if called from the event loop thread."""
+        try:
+            return asyncio.get_running_loop() is self.hass.loop
+        except RuntimeError:
+            return False
+
+    def _add_pending_request(self, miio_id, future):
+        """Track request awaiting result. Evict oldest when table is full."""
+        while len(self._pending_requests) >= MAX_PENDING_REQUESTS:
+            old_id, old_future = self._pending_requests.popitem(last=False)
+            _LOGGER.debug("Evicting pending request %s", old_id)
+            if not old_future.done():
+                old_future.set_exception(asyncio.TimeoutError("Evicted"))
+        self._pending_requests[miio_id] = future
+
+    def _invalidate_props(self, method):
+        """Forget cached gateway property that command changes."""
+        prop = COALESCE_GROUPS.get(method)
+        if prop is None and method is not None and method.startswith("set_"):
+            prop = method[len("set_"):]
+        if prop is not None:
+            self.prop_cache.invalidate(GATEWAY_SID, prop)
+
+    async def _async_read_props(self, props):
+        """Read properties in single request, one by one if hub refuses it."""
+        self.metrics.inc("prop_syncs")
+        if self._multi_get_prop and len(props) > 1:
+            try:
+                result = await self.async_request({"method": METHOD_GET_PROP, "params": list(props)})
+            except XiaomiGwRequestError as e:
+                _LOGGER.debug("Multi-property get_prop refused: %s", e)
+                result = None
+            if isinstance(result, list) and len(result) == len(props):
+                return dict(zip(props, result))
+            _LOGGER.info("Gateway %s can't read multiple properties at once", self.host)
+            self._multi_get_prop = False
+        values = {}
+        for prop in props:
+            values[prop] = await self.async_get_prop(prop)
+        return values
+
+    def _result_value(self, result):
+        """Convert '{"result":["ok"]}' to single value "ok"."""
+        if isinstance(result, list):
+            # Parse '[]' result.
+            if len(result) == 0:
+                result = "unknown"
+            else:
+                result = result[0]
+        return result
 
     """Gateway availability."""
 
+    @callback
     def _track_availability(self):
         """Check pings status and schedule next availability check."""
         _LOGGER.debug("Starting to track availability...")
-        # Schedule pings every TIME_INTERVAL_PING.
+        # Schedule pings every `ping_interval`.
         self._availability_pinger = async_track_time_interval(
-            self.hass, self._ping, TIME_INTERVAL_PING)
+            self.hass, self._async_ping, self._ping_interval)
 
     def _set_availability(self, available):
         """Set availability of the gateway. Inform child devices."""
@@ -261,23 +882,44 @@ class XiaomiGw:
         availability_changed = (not available and was_available) or (available and not was_available)
         if available:
             self._available = True
-            self._pings_sent = 0
+            self._ping_failures = 0
         else:
             self._available = False
 
         if availability_changed:
-            _LOGGER.info("Gateway availability changed! Available: " + str(available))
-            for func in self._callbacks:
-                func(None, None, EVENT_AVAILABILITY)
+            if available:
+                # Properties may have changed while gateway was away.
+                self._sync_task = None
+                self.prop_cache.clear()
+            _LOGGER.info("Gateway %s availability changed! Available: %s", self.host, available)
+            self._dispatcher.dispatch(self._unique_id, None, None, EVENT_AVAILABILITY)
+
+    async def _async_ping(self, now=None):
+        """Send ping and await pong without blocking the loop."""
+        if self._ping_waiter is not None:
+            # Previous ping still in flight.
+            return
+        self._ping_waiter = self.hass.loop.create_future()
+        miio_id, ping = self._miio_msg_encode({"method": METHOD_PING})
+        sent = monotonic()
+        self._send_datagram(ping)
+        try:
+            await asyncio.wait_for(self._ping_waiter, self._ping_timeout)
+        except asyncio.TimeoutError:
+            self._ping_rtts.append(None)
+            self._ping_failures = self._ping_failures + 1
+            _LOGGER.debug("Ping timeout, %s consecutive failures", self._ping_failures)
+            if self._ping_failures >= self._ping_failures_limit:
+                self._set_availability(False)
+        else:
+            self._ping_rtts.append(monotonic() - sent)
+        finally:
+            self._ping_waiter = None
 
-    @callback
-    def _ping(self, event=None):
-        """Queue ping to keep and check connection."""
-        self._pings_sent = self._pings_sent + 1
-        self.send_to_hub({"method": "internal.PING"})
-        sleep(6) # Give it `timeout` time to respond...
-        if self._pings_sent >= 3:
-            self._set_availability(False)
+    def _pong_received(self):
+        """Resolve ping in flight."""
+        if self._ping_waiter is not None and not self._ping_waiter.done():
+            self._ping_waiter.set_result(True)
 
     """Miio gateway protocol parsing."""
 
@@ -285,89 +927,134 @@ class XiaomiGw:
         """Parse received data."""
         for res in resps:
 
-            if "result" in res:
+            if "result" in res or "error" in res:
                 """Handling request result response."""
 
-                miio_id = res.get("id")
-                if miio_id is not None and miio_id in self._result_callbacks:
-
-                    result = res.get("result")
-                    # Convert '{"result":["ok"]}' to single value "ok".
-                    if isinstance(result, list):
-                        # Parse '[]' result.
-                        if len(result) == 0:
-                            result = "unknown"
-                        else:
-                            result = result[0]
-                    self._result_callbacks[miio_id](result)
+                future = self._pending_requests.pop(res.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in res:
+                    future.set_exception(XiaomiGwRequestError(res.get("error")))
+                else:
+                    future.set_result(res.get("result"))
 
             elif "method" in res:
                 """Handling new data received."""
 
-                if "model" not in res:
-                    res["model"] = "lumi.gateway.mieu01"
-                model = res.get("model")
-
-                if "sid" not in res:
-                    res["sid"] = "miio.gateway"
-                sid = res.get("sid")
-
-                params = res.get("params")
-                if params is None:
-                    # Ensure params is dict
-                    params = {}
-                if isinstance(params, list):
-                    # Parse '[]' params
-                    if len(params) == 0:
-                        # Convert empty list to empty dict
-                        params = {}
-                    else:
-                        # Extract list to dict
-                        params = params[0]
-                    if not isinstance(params, dict):
-                        params = { "data": params }
-
-                method = res.get("method")
-                if method.startswith("internal."):
-                    """Internal method, nothing to do here."""
-                    continue
-                elif method in ["_sync.neighborDevInfo"]:
-                    """Known but non-handled method."""
-                    continue
-                elif method.startswith("event."):
-                    """Received event."""
-                    event = method
-                    self._event_received(model, sid, event)
-                elif method == "_otc.log":
-                    """Received metadata."""
-                    event = EVENT_METADATA
-                elif method == "props":
-                    """Received values."""
-                    event = EVENT_VALUES
-                else:
-                    """Unknown method."""
-                    _LOGGER.info("Received unknown method: " + str(method))
+                method = res["method"]
+                sid = res.get("sid", GATEWAY_SID)
+                params = self._normalize_params(res.get("params"))
+                if ((method == "props" or method.startswith("event."))
+                        and self._duplicates.is_duplicate(sid, method, params)):
+                    if _LOGGER.isEnabledFor(logging.DEBUG):
+                        _LOGGER.debug("Suppressed duplicate %s of %s", method, sid)
                     continue
-
-                # Now we have all the data we need
-                for func in self._callbacks:
-                    func(model, sid, event, params)
+                handler = self._resolved_handlers.get(method)
+                if handler is None:
+                    handler = self._resolve_handler(method)
+                try:
+                    handler(res.get("model", GATEWAY_MODEL), sid, method, params)
+                except Exception:
+                    # Keep the rest of datagram's messages.
+                    _LOGGER.exception("Error while handling %s of %s", method, sid)
 
             else:
                 """Nothing that we can handle."""
-                _LOGGER.error("Non-parseable data: " + str(res))
+                _LOGGER.error("Non-parseable data: %s", res)
+
+    def _resolve_handler(self, method):
+        """Find handler of method and memoize it."""
+        handler = self._method_handlers.get(method)
+        if handler is None:
+            dot = method.find(".")
+            if dot >= 0:
+                handler = self._prefix_handlers.get(method[:dot + 1])
+        if handler is None:
+            handler = self._handle_unknown
+        self._resolved_handlers[method] = handler
+        return handler
+
+    def _normalize_params(self, params):
+        """Ensure params is dict."""
+        if type(params) is dict:
+            return params
+        if params is None:
+            return {}
+        if isinstance(params, list):
+            # Parse '[]' params
+            if len(params) == 0:
+                # Convert empty list to empty dict
+                return {}
+            # Extract list to dict
+            params = params[0]
+            if isinstance(params, dict):
+                return params
+        return { "data": params }
+
+    def _handle_internal(self, model, sid, method, params):
+        """Internal method, nothing to do here."""
+        if method == METHOD_PONG:
+            self._pong_received()
+
+    def _handle_ignored(self, model, sid, method, params):
+        """Known but non-handled method."""
+        pass
+
+    def _handle_unknown(self, model, sid, method, params):
+        self.metrics.inc("unknown_methods")
+        _LOGGER.info("Received unknown method: %s", method)
+
+    def _handle_event(self, model, sid, method, params):
+        """Received event."""
+        self._event_received(model, sid, method)
+        self._dispatcher.dispatch(self._unique_id, model, sid, method, params)
+
+    def _handle_metadata(self, model, sid, method, params):
+        """Received metadata. Decoded once for all device's entities."""
+        device = self._device_seen(model, sid)
+        values = decode_values(params)
+        if "subdev_zigbee" in values:
+            device.voltage = values.voltage
+            device.lqi = values.lqi
+        self._dispatcher.dispatch(self._unique_id, model, sid, EVENT_METADATA, values)
+
+    def _handle_values(self, model, sid, method, params):
+        """Received values. Decoded once for all device's entities."""
+        self._device_seen(model, sid)
+        self.prop_cache.update(sid, params)
+        self._dispatcher.dispatch(self._unique_id, model, sid, EVENT_VALUES, decode_values(params))
 
     def _event_received(self, model, sid, event):
         """Callback for receiving sensor event from gateway."""
-        _LOGGER.debug("Received event: " + str(model) + " " + str(sid) + " - " + str(event))
-        if sid not in self._known_sids:
-            _LOGGER.warning("Received event from unregistered sensor: " + str(model) + " " + str(sid) + " - " + str(event))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received event: %s %s - %s", model, sid, event)
+        device = self._device_seen(model, sid)
+        if not device.configured and not device.discovered:
+            _LOGGER.warning("Received event from unregistered sensor: %s %s - %s", model, sid, event)
+
+    def _device_seen(self, model, sid):
+        """Record traffic of device, discovering it if unconfigured."""
+        device = self.registry.seen(sid, model, utcnow())
+        if self.discovery and not device.configured and not device.discovered:
+            self._discover(device)
+        return device
+
+    def _discover(self, device):
+        """Announce entities of unconfigured device to platforms."""
+        if not self._discovery_started:
+            return
+        kinds = entities_for_model(device.model)
+        if not kinds:
+            return
+        device.discovered = True
+        _LOGGER.info("Discovered %s %s on %s", device.model, device.sid, self.host)
+        async_dispatcher_send(self.hass, SIGNAL_DEVICE_DISCOVERED, self, device.sid, kinds)
 
     """Miio."""
 
     def _miio_msg_encode(self, data):
         """Encode data to be sent to gateway."""
-        if data.get("method") and data.get("method") == "internal.PING":
+        if data.get("method") and data.get("method") == METHOD_PING:
             msg = data
         else:
             if self._miio_id != 12345:
@@ -382,24 +1069,431 @@ class XiaomiGw:
 
     def _miio_msg_decode(self, data):
         """Decode data received from gateway."""
+        resps, errors = decode_frames(data)
+        if errors:
+            self.metrics.inc("decode_errors", len(errors))
+        for offset, reason in errors:
+            _LOGGER.warning("Bad JSON received at %s (%s): %s", offset, reason, data)
+        return resps
+
 
-        # Trim `0` from the end of data string.
-        if data[-1] == 0:
-            data = data[:-1]
+class XiaomiGwSendQueue:
+    """Outgoing command pipeline with backpressure policy. Event loop only."""
+
+    def __init__(self, loop, send, maxsize, policy, interval):
+        self._loop = loop
+        self._send = send
+        self._maxsize = maxsize
+        self._policy = policy
+        self._interval = interval
+
+        # Entries: [method, payload, enqueued at, coalescable].
+        self._queue = deque()
+        self._space_waiters = deque()
+        self._drain_handle = None
+        self._last_sent = None
+
+        self._sent = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def put(self, method, payload, coalescable=False):
+        """Queue payload. Return False if it has to wait for space."""
+        now = self._loop.time()
+        if not self._queue and self._drain_handle is None and self._can_send(now):
+            # Nothing queued - go straight to the wire.
+            self._transmit(payload, now, now)
+            return True
 
-        # Prepare array of responses.
-        resps = []
+        if len(self._queue) >= self._maxsize:
+            if self._policy == SEND_POLICY_COALESCE and coalescable and self._coalesce(method, payload):
+                return True
+            if self._policy == SEND_POLICY_BLOCK:
+                return False
+            self._queue.popleft()
+            self._dropped = self._dropped + 1
+            _LOGGER.warning("Send queue full, dropped oldest command")
+
+        self._queue.append([method, payload, now, coalescable])
+        self._max_depth = max(self._max_depth, len(self._queue))
+        self._schedule_drain(now)
+        return True
+
+    async def async_put(self, method, payload, coalescable=False):
+        """Queue payload, waiting for space when policy is to block."""
+        while not self.put(method, payload, coalescable):
+            waiter = self._loop.create_future()
+            self._space_waiters.append(waiter)
+            await waiter
+
+    def close(self):
+        """Drop queued commands and release blocked producers."""
+        if self._drain_handle is not None:
+            self._drain_handle.cancel()
+            self._drain_handle = None
+        self._queue.clear()
+        while self._space_waiters:
+            waiter = self._space_waiters.popleft()
+            if not waiter.done():
+                waiter.cancel()
+
+    def stats(self):
+        """Return queue depth and wait time metrics."""
+        return {
+            "depth": len(self._queue),
+            "max_depth": self._max_depth,
+            "sent": self._sent,
+            "dropped": self._dropped,
+            "coalesced": self._coalesced,
+            "wait_avg_ms": round(1000 * self._wait_total / self._sent, 2) if self._sent else None,
+            "wait_max_ms": round(1000 * self._wait_max, 2),
+        }
+
+    def _coalesce(self, method, payload):
+        """Replace newest queued command of the same method."""
+        for entry in reversed(self._queue):
+            if entry[0] == method and entry[3]:
+                entry[1] = payload
+                self._coalesced = self._coalesced + 1
+                return True
+        return False
+
+    def _can_send(self, now):
+        return self._last_sent is None or now >= self._last_sent + self._interval
+
+    def _schedule_drain(self, now):
+        if self._drain_handle is not None:
+            return
+        delay = 0
+        if not self._can_send(now):
+            delay = self._last_sent + self._interval - now
+        self._drain_handle = self._loop.call_later(delay, self._drain)
+
+    def _drain(self):
+        """Send next queued command and wake one blocked producer."""
+        self._drain_handle = None
+        if not self._queue:
+            return
+        method, payload, enqueued, coalescable = self._queue.popleft()
+        now = self._loop.time()
+        self._transmit(payload, enqueued, now)
+
+        while self._space_waiters:
+            waiter = self._space_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+        if self._queue:
+            self._schedule_drain(now)
+
+    def _transmit(self, payload, enqueued, now):
+        wait = now - enqueued
+        self._wait_total = self._wait_total + wait
+        self._wait_max = max(self._wait_max, wait)
+        self._sent = self._sent + 1
+        self._last_sent = now
+        self._send(payload)
+
+
+class XiaomiGwCoalescer:
+    """Collapses bursts of last-write-wins commands. Event loop only.
+
+    First command of a group goes out at once and opens a window; commands
+    of the same group arriving within the window replace each other and only
+    the newest one is sent when the window closes.
+    """
+
+    def __init__(self, loop, enqueue, window):
+        self._loop = loop
+        self._enqueue = enqueue
+        self._window = window
+        # group -> [pending (method, payload) or None, window timer handle]
+        self._groups = {}
+        self.coalesced = 0
+
+    def submit(self, method, payload):
+        """Return True if command was held back by the window."""
+        group = COALESCE_GROUPS.get(method)
+        if group is None or self._window <= 0:
+            return False
+        state = self._groups.get(group)
+        if state is None:
+            self._groups[group] = [None, self._loop.call_later(self._window, self._flush, group)]
+            return False
+        if state[0] is not None:
+            self.coalesced = self.coalesced + 1
+        state[0] = (method, payload)
+        return True
+
+    def close(self):
+        """Drop held commands."""
+        for pending, handle in self._groups.values():
+            handle.cancel()
+        self._groups.clear()
+
+    def _flush(self, group):
+        """Send newest held command and keep window open while busy."""
+        state = self._groups[group]
+        if state[0] is None:
+            del self._groups[group]
+            return
+        method, payload = state[0]
+        state[0] = None
+        state[1] = self._loop.call_later(self._window, self._flush, group)
+        self._enqueue(method, payload)
+
+
+class XiaomiGwRequestError(Exception):
+    """Gateway replied with error to request."""
+
+
+class XiaomiGwDispatcher:
+    """Routes gateway messages only to subscribers of message's gateway and SID."""
+
+    def __init__(self):
+        # (gateway, sid) -> {"all": [...], "events": {event: [...]}, "keys": {key: [...]}}
+        self._by_sid = {}
+        # gateway -> all its subscribers
+        self._subscribers = {}
+
+    def subscribe(self, callback, gateway, sid=None, events=None, keys=None):
+        """Subscribe callback to gateway's SID (None for any SID).
+
+        With `events` or `keys` given, callback receives only messages of
+        those events or messages carrying those params keys.
+        """
+        index = self._by_sid.setdefault((gateway, sid), {"all": [], "events": {}, "keys": {}})
+        lists = []
+        if events is None and keys is None:
+            lists.append(index["all"])
+        for event in events or []:
+            lists.append(index["events"].setdefault(event, []))
+        for key in keys or []:
+            lists.append(index["keys"].setdefault(key, []))
+        lists.append(self._subscribers.setdefault(gateway, []))
+        for subscribers in lists:
+            subscribers.append(callback)
+
+        def unsubscribe():
+            for subscribers in lists:
+                subscribers.remove(callback)
+
+        return unsubscribe
+
+    def dispatch(self, gateway, model, sid, event, params=None):
+        """Deliver message to interested subscribers."""
+        if event in GLOBAL_EVENTS:
+            targets = list(self._subscribers.get(gateway, ()))
+        else:
+            targets = []
+            for index in (self._by_sid.get((gateway, sid)), self._by_sid.get((gateway, None))):
+                if index is None:
+                    continue
+                targets.extend(index["all"])
+                targets.extend(index["events"].get(event, ()))
+                if params and index["keys"]:
+                    for key in params:
+                        targets.extend(index["keys"].get(key, ()))
+            if len(targets) > 1:
+                # Subscriber may match by both event and key.
+                targets = list(dict.fromkeys(targets))
+
+        for func in targets:
+            try:
+                if params is None:
+                    func(model, sid, event)
+                else:
+                    func(model, sid, event, params)
+            except Exception:
+                _LOGGER.exception("Error while handling gateway data")
+
+
+class XiaomiGwEngine:
+    """Shared socket and dispatcher of all configured gateways.
+
+    Supervises the socket: when it fails or is lost it's recreated with
+    exponential backoff and jitter, and gateways re-sync afterwards.
+    """
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.dispatcher = XiaomiGwDispatcher()
+        self.scheduler = ExpiryScheduler(hass.loop)
+
+        self._transport = None
+        self._protocol = None
+        self._starting = None
+        self._stopped = False
+        # (ip, port) -> XiaomiGw
+        self._gateways = {}
+
+        self._reconnect_handle = None
+        self._unsub_hass_stop = None
+        # Sockets failed in a row; binding works with the network down, so
+        # only data received through a socket proves it healthy.
+        self._failures = 0
+        self.reconnects = 0
+
+    async def async_start(self):
+        """Create datagram endpoint on the event loop. Safe to await repeatedly."""
+        if self._starting is None:
+            self._starting = self.hass.async_create_task(self._async_create_endpoint())
+        await asyncio.shield(self._starting)
+
+    async def _async_create_endpoint(self):
+        """Create socket. On failure retry later instead of raising."""
+        _LOGGER.debug("Creating socket...")
         try:
-            data_arr = "[" + data.decode().replace("}{", "},{") + "]"
-            resps = json.loads(data_arr)
-        except:
-            _LOGGER.warning("Bad JSON received: " + str(data))
-        return resps
+            self._transport, self._protocol = await self.hass.loop.create_datagram_endpoint(
+                lambda: XiaomiGwProtocol(self),
+                family=socket.AF_INET, local_addr=("0.0.0.0", 0))
+        except OSError as e:
+            self._failures = self._failures + 1
+            _LOGGER.error("Can't create socket: %s", e)
+            self._schedule_reconnect()
+            return False
+        return True
+
+    @callback
+    def stop_with_hass(self):
+        """Gently stop on HASS stop."""
+        self._unsub_hass_stop = self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._hass_stopping)
+
+    @callback
+    def _hass_stopping(self, event):
+        # Fired listener is gone already.
+        self._unsub_hass_stop = None
+        self.gently_stop()
+
+    @callback
+    def gently_stop(self, event=None):
+        """Stops all gateways and closes socket."""
+        self._stopped = True
+        if self._unsub_hass_stop is not None:
+            self._unsub_hass_stop()
+            self._unsub_hass_stop = None
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        for gateway in list(self._gateways.values()):
+            gateway.gently_stop()
+        self.scheduler.close()
+        self._close_transport()
+
+    def _close_transport(self):
+        if self._transport is not None:
+            _LOGGER.debug("Closing socket...")
+            self._transport.close()
+            self._transport = None
+            self._protocol = None
+
+    @callback
+    def _transport_failed(self, exc):
+        """Drop broken socket and schedule its recreation."""
+        _LOGGER.warning("Socket failed, recreating: %s", exc)
+        self._failures = self._failures + 1
+        self._close_transport()
+        self._schedule_reconnect()
+
+    @callback
+    def _schedule_reconnect(self):
+        if self._stopped or self._reconnect_handle is not None:
+            return
+        # Exponential backoff with equal jitter.
+        delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** self._failures)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        _LOGGER.debug("Recreating socket in %.1f s", delay)
+        self._reconnect_handle = self.hass.loop.call_later(delay, self._reconnect)
+
+    @callback
+    def _reconnect(self):
+        self._reconnect_handle = None
+        self.hass.async_create_task(self._async_reconnect())
+
+    async def _async_reconnect(self):
+        if self._stopped or self._transport is not None:
+            return
+        if not await self._async_create_endpoint():
+            return
+        self.reconnects = self.reconnects + 1
+        _LOGGER.info("Socket recreated (%s reconnects)", self.reconnects)
+        for gateway in list(self._gateways.values()):
+            gateway._transport_reconnected()
+
+    def register(self, addr, gateway):
+        self._gateways[addr] = gateway
+
+    def unregister(self, addr):
+        self._gateways.pop(addr, None)
+
+    @callback
+    def sendto(self, data, addr):
+        """Send encoded data. Must run in the event loop."""
+        if self._transport is None:
+            # Socket is being recreated.
+            _LOGGER.debug("No socket to send data to!")
+            return
+        self._transport.sendto(data, addr)
+
+    @callback
+    def datagram_received(self, data, addr):
+        self._failures = 0
+        gateway = self._gateways.get(addr)
+        if gateway is None:
+            _LOGGER.debug("Received data from unknown gateway %s", addr)
+            return
+        gateway._datagram_received(data)
+
+    @callback
+    def error_received(self, exc):
+        # Datagram errors don't carry the peer, let every gateway know.
+        for gateway in list(self._gateways.values()):
+            gateway._transport_error(exc)
+        if isinstance(exc, OSError) and exc.errno in FATAL_SOCKET_ERRORS:
+            self._transport_failed(exc)
+
+    @callback
+    def connection_lost(self, protocol, exc):
+        """Socket closed without us asking for it."""
+        if protocol is self._protocol and not self._stopped:
+            self._transport = None
+            self._protocol = None
+            self._transport_failed(exc)
+
+
+class XiaomiGwProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol feeding the engine from the event loop."""
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def datagram_received(self, data, addr):
+        self._engine.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        self._engine.error_received(exc)
+
+    def connection_lost(self, exc):
+        self._engine.connection_lost(self, exc)
 
 
 class XiaomiGwDevice(RestoreEntity):
     """A generic device of Gateway."""
 
+    # Params keys device is interested in; None to receive all SID's data.
+    _params_keys = None
+
+    # Attributes kept in warm-start snapshot.
+    _snapshot_fields = ("_voltage", "_lqi", "_model")
+    # Momentary states (clicks, playing) are not worth restoring.
+    _snapshot_state = True
+    # Gateway properties read through shared `async_sync_props`.
+    _gateway_props = ()
+
     def __init__(self, gw, platform, device_class = None, sid = None, name = None, restore = None):
         """Initialize the device."""
 
@@ -412,25 +1506,54 @@ class XiaomiGwDevice(RestoreEntity):
         self._name = name
 
         self._model = None
+        self._unsubscribe = None
+        self._written_state = None
+        self._state_write = None
         self._voltage = None
         self._lqi = None
         self._alive = None
 
+        prefix = gw.entity_prefix
         if device_class is None:
-            self._unique_id = "{}_{}".format(sid, platform)
-            self.entity_id = platform + "." + sid.replace(".", "_")
+            self._unique_id = "{}{}_{}".format(prefix, sid, platform)
+            self.entity_id = platform + "." + prefix + sid.replace(".", "_")
         else:
-            self._unique_id = "{}_{}_{}".format(sid, platform, device_class)
-            self.entity_id = platform + "." + sid.replace(".", "_") + "_" + device_class
+            self._unique_id = "{}{}_{}_{}".format(prefix, sid, platform, device_class)
+            self.entity_id = platform + "." + prefix + sid.replace(".", "_") + "_" + device_class
 
     async def async_added_to_hass(self):
         """Add push data listener for this device."""
-        self._gw.append_callback(self._add_push_data_job)
+        snapshot = self.hass.data.get(DATA_SNAPSHOT)
+        if snapshot is not None:
+            snapshot.restore_entity(self)
+        events = None
+        if self._params_keys is not None:
+            # Generic handlers still need device's keepalive and metadata.
+            events = [EVENT_KEEPALIVE, EVENT_METADATA]
+        self._unsubscribe = self._gw.append_callback(
+            self._push_data, self._sid, events, self._params_keys)
+        self._gw.registry.attach(self._sid, self.entity_id)
+        # Registered up front so the first sync reads properties of all entities.
+        self._gw.register_sync_props(self._gateway_props)
+        self.hass.async_create_task(self.async_update_device_params())
         if self._restore:
             state = await self.async_get_last_state()
             if state is not None:
                 self._state = state.state
 
+    async def async_will_remove_from_hass(self):
+        """Remove push data listener."""
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        self._gw.registry.detach(self._sid, self.entity_id)
+        snapshot = self.hass.data.get(DATA_SNAPSHOT)
+        if snapshot is not None:
+            snapshot.forget_entity(self)
+        if self._state_write is not None:
+            self._state_write.cancel()
+            self._state_write = None
+
     @property
     def name(self):
         return self._name
@@ -452,9 +1575,6 @@ class XiaomiGwDevice(RestoreEntity):
         attrs = { ATTR_VOLTAGE: self._voltage, ATTR_LQI: self._lqi, ATTR_MODEL: self._model, ATTR_ALIVE: self._alive }
         return attrs
 
-    def _add_push_data_job(self, *args):
-        self.hass.add_job(self._push_data, *args)
-
     @callback
     def _push_data(self, model = None, sid = None, event = None, params = {}):
         """Push data that came from gateway to parser. Update HA state if any changes were made."""
@@ -464,21 +1584,84 @@ class XiaomiGwDevice(RestoreEntity):
         if init_parse is not None:
             # Update HA state
             if init_parse == True:
-                self.async_schedule_update_ha_state()
+                self._schedule_state_write()
             return
 
         # If parsed some data
-        has_data = self.parse_incoming_data(model, sid, event, params)
+        metrics = self._gw.metrics
+        if metrics.enabled:
+            started = perf_counter()
+            has_data = self.parse_incoming_data(model, sid, event, params)
+            metrics.observe("parse." + self.entity_id, perf_counter() - started)
+        else:
+            has_data = self.parse_incoming_data(model, sid, event, params)
         if has_data:
             # Update HA state
-            self.async_schedule_update_ha_state()
+            self._schedule_state_write()
+            return
+
+    @callback
+    def _schedule_state_write(self):
+        """Write HA state, merging writes within gateway's state write window."""
+        if self._state_write is not None:
+            return
+        window = self._gw.state_write_window
+        if window > 0:
+            self._state_write = self.hass.loop.call_later(window, self._write_state_if_changed)
+        else:
+            self._write_state_if_changed()
+
+    @callback
+    def _write_state_if_changed(self):
+        """Write HA state unless state and attributes are the same as last written."""
+        self._state_write = None
+        if self._current_state() == self._written_state:
             return
+        self.async_write_ha_state()
+
+    def _current_state(self):
+        return (self.available, self.state, self.state_attributes, self.extra_state_attributes)
+
+    @callback
+    def async_write_ha_state(self):
+        """Write HA state and remember it, whichever path wrote it."""
+        self._written_state = self._current_state()
+        super().async_write_ha_state()
+
+    def schedule_update_ha_state(self, force_refresh=False):
+        # State gets written later by HA; don't let next push be skipped against older one.
+        self._written_state = None
+        super().schedule_update_ha_state(force_refresh)
+
+    @callback
+    def async_schedule_update_ha_state(self, force_refresh=False):
+        self._written_state = None
+        super().async_schedule_update_ha_state(force_refresh)
+
+    def snapshot_record(self):
+        """Return last known values for warm-start snapshot."""
+        record = {field.lstrip("_"): serialize(getattr(self, field)) for field in self._snapshot_fields}
+        record["alive"] = serialize(self._alive)
+        if self._snapshot_state:
+            record["state"] = self._state
+        return record
+
+    def snapshot_restore(self, record):
+        """Take values of snapshot record. Live data overwrites them later."""
+        for field in self._snapshot_fields:
+            value = record.get(field.lstrip("_"))
+            if value is not None:
+                setattr(self, field, tuple(value) if isinstance(value, list) else value)
+        if record.get("alive"):
+            self._alive = parse_datetime(record["alive"])
+        if self._snapshot_state and record.get("state") is not None:
+            self._state = record["state"]
 
     def parse_incoming_data(self, model, sid, event, params):
         """Parse incoming data from gateway. Abstract."""
         raise NotImplementedError()
 
-    def update_device_params(self):
+    async def async_update_device_params(self):
         """If component needs to read data first to get it's state."""
         pass
 
@@ -488,7 +1671,7 @@ class XiaomiGwDevice(RestoreEntity):
         # Generic handler for availability change
         # Devices are getting availability state from Gateway itself
         if event == EVENT_AVAILABILITY:
-            self.update_device_params()
+            self.hass.async_create_task(self.async_update_device_params())
             return True
 
         if self._sid != sid:
@@ -502,13 +1685,12 @@ class XiaomiGwDevice(RestoreEntity):
             self._alive = utcnow()
             return True
 
-        # Generic handler for _otg.log
+        # Generic handler for _otg.log, params are decoded DeviceValues
         if event == EVENT_METADATA:
-            zigbeeData = params.get("subdev_zigbee")
-            if zigbeeData is not None:
-                self._voltage = zigbeeData.get("voltage")
-                self._lqi = zigbeeData.get("lqi")
-                _LOGGER.info("Vol:" + str(self._voltage) + " lqi:" + str(self._lqi))
+            if "subdev_zigbee" in params:
+                self._voltage = params.voltage
+                self._lqi = params.lqi
+                _LOGGER.debug("Vol: %s lqi: %s", self._voltage, self._lqi)
                 return True
             return False
 
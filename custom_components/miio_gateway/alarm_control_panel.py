@@ -1,8 +1,9 @@
+import asyncio
 import logging
 
 import homeassistant.components.alarm_control_panel as alarm
 
-from . import DOMAIN, XiaomiGwDevice
+from . import DOMAIN, XiaomiGwDevice, XiaomiGwRequestError
 
 from homeassistant.const import (
     STATE_ALARM_ARMED_AWAY, STATE_ALARM_ARMED_HOME, STATE_ALARM_ARMED_NIGHT,
@@ -14,15 +15,17 @@ from homeassistant.components.alarm_control_panel.const import (
 
 _LOGGER = logging.getLogger(__name__)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     _LOGGER.info("Setting up alarm")
-    devices = []
-    gateway = hass.data[DOMAIN]
-    devices.append(XiaomiGatewayAlarm(gateway))
-    add_entities(devices)
+    gateway = hass.data[DOMAIN][entry.entry_id]
+    async_add_entities([XiaomiGatewayAlarm(gateway)])
 
 class XiaomiGatewayAlarm(XiaomiGwDevice, alarm.AlarmControlPanelEntity):
 
+    _params_keys = ["arming", "alarming_volume"]
+    _snapshot_fields = XiaomiGwDevice._snapshot_fields + ("_volume", "_state_by_volume")
+    _gateway_props = ("alarming_volume", "arming")
+
     def __init__(self, gw):
         XiaomiGwDevice.__init__(self, gw, "alarm_control_panel", None, "miio.gateway", "Gateway Alarm")
 
@@ -33,16 +36,22 @@ class XiaomiGatewayAlarm(XiaomiGwDevice, alarm.AlarmControlPanelEntity):
         self._ringtone = 1
         self._color = "ff0000"
 
-        self.update_device_params()
-
-    def update_device_params(self):
-        if self._gw.is_available():
-            self._send_to_hub({ "method": "get_prop", "params": ["arming"] }, self._init_set_arming)
-            self._send_to_hub({ "method": "get_prop", "params": ["alarming_volume"] }, self._init_set_volume)
+    async def async_update_device_params(self):
+        if not self._gw.is_available():
+            return
+        try:
+            props = await self._gw.async_sync_props(self._gateway_props)
+        except (asyncio.TimeoutError, XiaomiGwRequestError) as e:
+            _LOGGER.warning("Can't read alarm state: %s", e)
+            return
+        # Volume first - armed state depends on it.
+        self._init_set_volume(props["alarming_volume"])
+        self._init_set_arming(props["arming"])
+        self.async_write_ha_state()
 
     def _init_set_arming(self, result):
         if result is not None:
-            _LOGGER.info("SETTING ARMED: " + str(result))
+            _LOGGER.debug("Setting armed: %s", result)
             if result == "on":
                 self._state = self._state_by_volume
             elif result == "off":
@@ -50,7 +59,7 @@ class XiaomiGatewayAlarm(XiaomiGwDevice, alarm.AlarmControlPanelEntity):
 
     def _init_set_volume(self, result):
         if result is not None:
-            _LOGGER.info("SETTING ARMED VOL: " + str(result))
+            _LOGGER.debug("Setting armed volume: %s", result)
             self._volume = int(result)
             self._state_by_volume = self._get_state_by_volume(self._volume)
             if self._is_armed():
@@ -1,14 +1,13 @@
 import logging
-from datetime import timedelta
 
-import homeassistant.util.dt as dt_util
 from homeassistant.components.binary_sensor import (
     BinarySensorEntity, DEVICE_CLASSES)
 from homeassistant.const import STATE_OFF, STATE_ON
-from homeassistant.helpers.event import async_track_point_in_utc_time
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
 from . import DOMAIN, CONF_DATA_DOMAIN, CONF_SENSOR_SID, CONF_SENSOR_CLASS, CONF_SENSOR_NAME, CONF_SENSOR_RESTORE, \
-    EVENT_VALUES, XiaomiGwDevice
+    CONF_SENSOR_RESET, MOMENTARY_RESET, EVENT_VALUES, SIGNAL_DEVICE_DISCOVERED, XiaomiGwDevice
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -45,17 +44,16 @@ EVENT_LONG_RELEASE = "event.long_click_release"
 IGNORED_EVENTS = [EVENT_VALUES, EVENT_TILT_ANGLE, EVENT_COORDINATION]
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     _LOGGER.info("Setting up binary sensors")
 
     # Make a list of all default + custom device classes
-    all_device_classes = DEVICE_CLASSES
-    all_device_classes.append(DEVICE_CLASS_BUTTON)
+    all_device_classes = list(DEVICE_CLASSES) + [DEVICE_CLASS_BUTTON]
 
-    gateway = hass.data[DOMAIN]
     entities = []
 
-    for cfg in hass.data[CONF_DATA_DOMAIN]:
+    gateway = hass.data[DOMAIN][entry.entry_id]
+    for cfg in hass.data[CONF_DATA_DOMAIN][gateway.unique_id()]:
         if not cfg:
             cfg = {}
 
@@ -63,6 +61,7 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         device_class = cfg.get(CONF_SENSOR_CLASS)
         name = cfg.get(CONF_SENSOR_NAME)
         restore = cfg.get(CONF_SENSOR_RESTORE)
+        reset_after = cfg.get(CONF_SENSOR_RESET, MOMENTARY_RESET)
 
         if sid is None or device_class is None:
             continue
@@ -70,20 +69,34 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         gateway.append_known_sid(sid)
 
         if device_class in all_device_classes:
-            _LOGGER.info("Registering " + str(device_class) + " sid " + str(sid) + " as binary_sensor")
-            entities.append(XiaomiGwBinarySensor(gateway, device_class, sid, name, restore))
+            _LOGGER.info("Registering %s sid %s as binary_sensor", device_class, sid)
+            entities.append(XiaomiGwBinarySensor(gateway, device_class, sid, name, restore, reset_after))
+
+    @callback
+    def device_discovered(discovered_gateway, sid, kinds):
+        if discovered_gateway is not gateway:
+            return
+        discovered = [XiaomiGwBinarySensor(gateway, device_class, sid, None, False)
+                      for platform, device_class in kinds if platform == "binary_sensor"]
+        if discovered:
+            _LOGGER.info("Adding discovered sid %s as binary_sensor", sid)
+            async_add_entities(discovered)
+    entry.async_on_unload(async_dispatcher_connect(hass, SIGNAL_DEVICE_DISCOVERED, device_discovered))
 
     if not entities:
         _LOGGER.info("No binary_sensors configured")
-        return False
+        return
 
-    add_entities(entities)
-    return True
+    async_add_entities(entities)
 
 
 class XiaomiGwBinarySensor(XiaomiGwDevice, BinarySensorEntity):
 
-    def __init__(self, gw, device_class, sid, name, restore):
+    _snapshot_fields = XiaomiGwDevice._snapshot_fields + ("_last_action",)
+    # State is restored only with restore option.
+    _snapshot_state = False
+
+    def __init__(self, gw, device_class, sid, name, restore, reset_after=MOMENTARY_RESET):
         XiaomiGwDevice.__init__(self, gw, "binary_sensor", device_class, sid, name, restore)
 
         # Custom Button device class
@@ -94,7 +107,8 @@ class XiaomiGwBinarySensor(XiaomiGwDevice, BinarySensorEntity):
 
         self._last_action = None
 
-        self._state_timer = None
+        # Seconds after which momentary state (click, vibration...) resets.
+        self._reset_after = reset_after.total_seconds()
 
     @property
     def is_on(self):
@@ -133,16 +147,16 @@ class XiaomiGwBinarySensor(XiaomiGwDevice, BinarySensorEntity):
 
         return True
 
+    async def async_will_remove_from_hass(self):
+        await super().async_will_remove_from_hass()
+        self._gw.scheduler.cancel(self)
+
     def _start_state_timer(self):
-        """Start state timer."""
-        if self._state_timer is not None:
-            self._state_timer()
-            self._state_timer = None
-        restore_state_time = dt_util.utcnow() + timedelta(seconds=15)
-        self._state_timer = async_track_point_in_utc_time(self.hass, self._stop_state_timer, restore_state_time)
-
-    def _stop_state_timer(self, time):
-        """Stop state timer."""
-        self._state_timer = None
+        """Start (or restart) reset of momentary state by shared scheduler."""
+        self._gw.scheduler.schedule(self, self._reset_after, self._stop_state_timer)
+
+    @callback
+    def _stop_state_timer(self):
+        """Reset momentary state."""
         self._state = STATE_OFF
-        self.schedule_update_ha_state()
+        self._schedule_state_write()
@@ -0,0 +1,43 @@
+"""Property values of gateway and its sub-devices with expiry."""
+from time import monotonic
+
+
+class PropertyCache:
+    """Values keyed by (sid, property), each living for its property's TTL."""
+
+    def __init__(self, default_ttl, ttls=None):
+        # Seconds; 0 disables caching of the property.
+        self._default_ttl = default_ttl
+        self._ttls = ttls or {}
+        # (sid, prop) -> (value, monotonic expiry)
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sid, prop):
+        """Return (True, value) for fresh value, (False, None) otherwise."""
+        entry = self._values.get((sid, prop))
+        if entry is not None:
+            if entry[1] > monotonic():
+                self.hits += 1
+                return True, entry[0]
+            del self._values[(sid, prop)]
+        self.misses += 1
+        return False, None
+
+    def update(self, sid, values):
+        """Store dict of property values of `sid`."""
+        now = monotonic()
+        for prop, value in values.items():
+            ttl = self._ttls.get(prop, self._default_ttl)
+            if ttl > 0:
+                self._values[(sid, prop)] = (value, now + ttl)
+
+    def invalidate(self, sid, prop):
+        self._values.pop((sid, prop), None)
+
+    def clear(self):
+        self._values.clear()
+
+    def stats(self):
+        return {"size": len(self._values), "hits": self.hits, "misses": self.misses}
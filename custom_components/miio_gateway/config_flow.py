@@ -0,0 +1,112 @@
+"""Config flow of Xiaomi Gateway."""
+import socket
+
+import voluptuous as vol
+
+from homeassistant import config_entries
+from homeassistant.const import CONF_NAME
+from homeassistant.core import callback
+from homeassistant.util import slugify
+
+from . import (
+    DOMAIN, CONF_HOST, CONF_PORT, CONF_ENTITY_PREFIX, CONF_YAML_SLOT, CONF_DISCOVERY, CONF_METRICS, CONF_TRACE)
+
+USER_SCHEMA = vol.Schema({
+    vol.Required(CONF_HOST): str,
+    vol.Optional(CONF_PORT, default=54321): int,
+    vol.Optional(CONF_NAME): str,
+})
+
+
+def _unique_id(config):
+    return "{}:{}".format(config[CONF_HOST], config.get(CONF_PORT, 54321))
+
+
+def _entity_prefix(entries, config):
+    """Return entity prefix no other entry uses. First gateway keeps unprefixed IDs."""
+    used = {entry.data.get(CONF_ENTITY_PREFIX, "") for entry in entries}
+    if "" not in used:
+        return ""
+    base = slugify(config.get(CONF_NAME, config[CONF_HOST]))
+    prefix = base + "_"
+    index = 2
+    while prefix in used:
+        prefix = "{}_{}_".format(base, index)
+        index = index + 1
+    return prefix
+
+
+class XiaomiGwConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
+    """Gateway set up from UI or imported from YAML."""
+
+    VERSION = 1
+
+    async def async_step_user(self, user_input=None):
+        errors = {}
+        if user_input is not None:
+            await self.async_set_unique_id(_unique_id(user_input))
+            self._abort_if_unique_id_configured()
+            try:
+                await self.hass.async_add_executor_job(socket.gethostbyname, user_input[CONF_HOST])
+            except OSError:
+                errors["base"] = "cannot_resolve"
+            else:
+                data = dict(user_input)
+                data[CONF_ENTITY_PREFIX] = _entity_prefix(self._async_current_entries(), user_input)
+                return self.async_create_entry(title=user_input.get(CONF_NAME, user_input[CONF_HOST]), data=data)
+
+        return self.async_show_form(step_id="user", data_schema=USER_SCHEMA, errors=errors)
+
+    async def async_step_import(self, import_config):
+        """Create entry of YAML gateway, or update entry of its YAML slot if YAML changed."""
+        unique_id = _unique_id(import_config)
+        entries = self._async_current_entries()
+        for entry in entries:
+            if entry.source != config_entries.SOURCE_IMPORT:
+                continue
+            slot = entry.data.get(CONF_YAML_SLOT)
+            # Entries imported before slots were stored are matched by address.
+            if slot == import_config[CONF_YAML_SLOT] or (slot is None and entry.unique_id == unique_id):
+                return self._async_update_import(entry, entries, unique_id, import_config)
+
+        await self.async_set_unique_id(unique_id)
+        self._abort_if_unique_id_configured()
+        data = dict(import_config)
+        data[CONF_ENTITY_PREFIX] = _entity_prefix(entries, import_config)
+        return self.async_create_entry(title=import_config.get(CONF_NAME, import_config[CONF_HOST]), data=data)
+
+    @callback
+    def _async_update_import(self, entry, entries, unique_id, import_config):
+        """Move entry to changed YAML, keeping its entity IDs. Reloaded by its update listener."""
+        if any(other is not entry and other.unique_id == unique_id for other in entries):
+            return self.async_abort(reason="already_configured")
+        data = dict(import_config)
+        data[CONF_ENTITY_PREFIX] = entry.data.get(CONF_ENTITY_PREFIX, "")
+        self.hass.config_entries.async_update_entry(
+            entry, data=data, unique_id=unique_id,
+            title=import_config.get(CONF_NAME, import_config[CONF_HOST]))
+        return self.async_abort(reason="already_configured")
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        return XiaomiGwOptionsFlow(config_entry)
+
+
+class XiaomiGwOptionsFlow(config_entries.OptionsFlow):
+    """Options applied by reloading the entry."""
+
+    def __init__(self, config_entry):
+        self._config_entry = config_entry
+
+    async def async_step_init(self, user_input=None):
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        current = dict(self._config_entry.data)
+        current.update(self._config_entry.options)
+        return self.async_show_form(step_id="init", data_schema=vol.Schema({
+            vol.Optional(CONF_DISCOVERY, default=current.get(CONF_DISCOVERY, False)): bool,
+            vol.Optional(CONF_METRICS, default=current.get(CONF_METRICS, False)): bool,
+            vol.Optional(CONF_TRACE, default=current.get(CONF_TRACE, 0)): vol.All(int, vol.Range(min=0)),
+        }))
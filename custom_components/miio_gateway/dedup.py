@@ -0,0 +1,50 @@
+"""Suppression of messages the hub repeats in quick succession."""
+import json
+from collections import OrderedDict
+from time import monotonic
+
+# Remembered (SID, method group) pairs; least recently heard are forgotten first.
+MAX_TRACKED_MESSAGES = 256
+
+
+class DuplicateFilter:
+    """Drops message repeating the previous one of its SID within `window` seconds.
+
+    Only the last message of each SID and method group (`event.*` or
+    `props`) is remembered, so a value coming back after a different one
+    (open, close, open) is always delivered. Messages are equal when their
+    method and params match. Window is fixed from the first copy, so a
+    steadily repeated message still gets through once per window.
+    """
+
+    def __init__(self, window, excluded=()):
+        self._window = window
+        # Methods always delivered, e.g. clicks that are genuinely repeated.
+        self._excluded = frozenset(excluded)
+        # (sid, group) -> (method, fingerprint, monotonic time of first copy)
+        self._last = OrderedDict()
+        self.suppressed = 0
+
+    def is_duplicate(self, sid, method, params):
+        if self._window <= 0:
+            return False
+        key = (sid, method.partition(".")[0])
+        if method in self._excluded:
+            # Still the previous message of its group for what comes next.
+            self._remember(key, (method, None, None))
+            return False
+        fingerprint = json.dumps(params, sort_keys=True, separators=(",", ":"))
+        now = monotonic()
+        last = self._last.get(key)
+        if (last is not None and last[0] == method and last[1] == fingerprint
+                and now - last[2] < self._window):
+            self.suppressed += 1
+            return True
+        self._remember(key, (method, fingerprint, now))
+        return False
+
+    def _remember(self, key, record):
+        self._last[key] = record
+        self._last.move_to_end(key)
+        if len(self._last) > MAX_TRACKED_MESSAGES:
+            self._last.popitem(last=False)
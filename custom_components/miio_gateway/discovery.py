@@ -0,0 +1,30 @@
+"""Entities created for discovered sub-devices by their model."""
+
+# Model family -> (platform, device class) of entities representing it.
+MODEL_ENTITIES = {
+    "lumi.sensor_motion": [("binary_sensor", "motion")],
+    "lumi.sensor_motion.aq2": [("binary_sensor", "motion"), ("sensor", "illuminance")],
+    "lumi.sensor_magnet": [("binary_sensor", "opening")],
+    "lumi.sensor_wleak": [("binary_sensor", "moisture")],
+    "lumi.sensor_smoke": [("binary_sensor", "smoke")],
+    "lumi.sensor_natgas": [("binary_sensor", "gas")],
+    "lumi.vibration": [("binary_sensor", "vibration")],
+    "lumi.sensor_switch": [("binary_sensor", "button")],
+    "lumi.remote": [("binary_sensor", "button")],
+    "lumi.sensor_ht": [("sensor", "temperature"), ("sensor", "humidity")],
+    "lumi.weather": [("sensor", "temperature"), ("sensor", "humidity"), ("sensor", "pressure")],
+}
+
+
+def entities_for_model(model):
+    """Return entity kinds of model, empty list if model is not known.
+
+    Looks up full model first (`lumi.sensor_motion.aq2`), then its family
+    without version suffix (`lumi.sensor_motion`).
+    """
+    if not model:
+        return []
+    kinds = MODEL_ENTITIES.get(model)
+    if kinds is None:
+        kinds = MODEL_ENTITIES.get(model.rsplit(".", 1)[0], [])
+    return kinds
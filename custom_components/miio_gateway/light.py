@@ -10,26 +10,29 @@ from . import DOMAIN, XiaomiGwDevice
 
 _LOGGER = logging.getLogger(__name__)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     _LOGGER.info("Setting up light")
-    devices = []
-    gateway = hass.data[DOMAIN]
-    devices.append(XiaomiGatewayLight(gateway))
-    add_entities(devices)
+    gateway = hass.data[DOMAIN][entry.entry_id]
+    async_add_entities([XiaomiGatewayLight(gateway)])
 
 class XiaomiGatewayLight(XiaomiGwDevice, LightEntity):
 
+    _params_keys = ["light"]
+    _snapshot_fields = XiaomiGwDevice._snapshot_fields + ("_hs", "_brightness")
+    # LED is switched off on start, restoring on/off would contradict it.
+    _snapshot_state = False
+
     def __init__(self, gw):
         XiaomiGwDevice.__init__(self, gw, "light", None, "miio.gateway", "Gateway LED")
         self._hs = (0, 0)
         self._brightness = 100
         self._state = False
 
-        self.update_device_params()
-
-    def update_device_params(self):
+    async def async_update_device_params(self):
         if self._gw.is_available():
             self._send_to_hub({ "method": "toggle_light", "params": ["off"] })
+            self._state = False
+            self.async_write_ha_state()
 
     @property
     def is_on(self):
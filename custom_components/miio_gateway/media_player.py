@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from datetime import timedelta
 
@@ -11,7 +12,7 @@ from homeassistant.core import callback
 from homeassistant.helpers.event import async_track_point_in_utc_time
 from homeassistant.util.dt import utcnow
 
-from . import DOMAIN, XiaomiGwDevice
+from . import DOMAIN, XiaomiGwDevice, XiaomiGwRequestError
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -20,15 +21,18 @@ PLAYING_TIME = timedelta(seconds=10)
 SUPPORT_PLAYER = SUPPORT_VOLUME_SET | SUPPORT_VOLUME_MUTE | SUPPORT_PLAY_MEDIA |\
     SUPPORT_PLAY | SUPPORT_STOP
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     _LOGGER.info("Setting up sound player")
-    devices = []
-    gateway = hass.data[DOMAIN]
-    devices.append(XiaomiGatewayLight(gateway))
-    add_entities(devices)
+    gateway = hass.data[DOMAIN][entry.entry_id]
+    async_add_entities([XiaomiGatewayLight(gateway)])
 
 class XiaomiGatewayLight(XiaomiGwDevice, MediaPlayerEntity):
 
+    _params_keys = ["gateway_volume"]
+    _snapshot_fields = XiaomiGwDevice._snapshot_fields + ("_volume", "_muted")
+    _snapshot_state = False
+    _gateway_props = ("gateway_volume",)
+
     def __init__(self, gw):
         XiaomiGwDevice.__init__(self, gw, "media_player", None, "miio.gateway", "Gateway Player")
         self._volume = None
@@ -37,15 +41,20 @@ class XiaomiGatewayLight(XiaomiGwDevice, MediaPlayerEntity):
         self._state = STATE_IDLE
         self._player_tracker = None
 
-        self.update_device_params()
-
-    def update_device_params(self):
-        if self._gw.is_available():
-            self._send_to_hub({ "method": "get_prop", "params": ["gateway_volume"] }, self._init_set_volume)
+    async def async_update_device_params(self):
+        if not self._gw.is_available():
+            return
+        try:
+            props = await self._gw.async_sync_props(self._gateway_props)
+        except (asyncio.TimeoutError, XiaomiGwRequestError) as e:
+            _LOGGER.warning("Can't read gateway volume: %s", e)
+            return
+        self._init_set_volume(props["gateway_volume"])
+        self.async_write_ha_state()
 
     def _init_set_volume(self, result):
         if result is not None:
-            _LOGGER.info("SETTING VOL: " + str(result))
+            _LOGGER.debug("Setting volume: %s", result)
             self._volume = int(result) / 100
 
     def set_volume_level(self, volume):
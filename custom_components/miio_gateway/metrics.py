@@ -0,0 +1,109 @@
+"""Counters and latency histograms of the gateway link."""
+from bisect import bisect_left
+
+# Histogram bucket upper bounds in seconds.
+BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram."""
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        # Last bucket counts values above BUCKETS[-1].
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Return upper bound of bucket holding given percentile."""
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg_ms": round(1000 * self.total / self.count, 3),
+            "p50_ms": round(1000 * self.percentile(50), 3),
+            "p99_ms": round(1000 * self.percentile(99), 3),
+            "max_ms": round(1000 * self.max, 3),
+        }
+
+
+class GatewayMetrics:
+    """Collector of gateway link metrics."""
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # name -> callable returning current value, read on snapshot.
+        self._gauges = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def add_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def value(self, name):
+        """Return counter or gauge value."""
+        if name in self._gauges:
+            return self._gauges[name]()
+        return self.counters.get(name, 0)
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "gauges": {name: func() for name, func in self._gauges.items()},
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+
+class NullMetrics:
+    """Collector used when metrics are disabled. Does nothing."""
+
+    enabled = False
+
+    def inc(self, name, value=1):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    def add_gauge(self, name, func):
+        pass
+
+    def value(self, name):
+        return None
+
+    def snapshot(self):
+        return {}
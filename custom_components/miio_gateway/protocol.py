@@ -0,0 +1,63 @@
+"""Miio gateway datagram framing.
+
+Gateway packs one or more JSON objects into a single datagram with no
+separator between them, optionally terminated with NUL byte.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_DECODER = json.JSONDecoder()
+_SKIPPED = " \t\n\r\x00"
+_BOUNDARY = "}{"
+
+
+def decode_frames(data):
+    """Decode datagram into list of messages.
+
+    Returns `(messages, errors)` where `errors` is a list of `(offset, reason)`
+    for every frame that couldn't be parsed. Valid frames around a corrupted
+    one are still returned.
+    """
+    if orjson is not None:
+        # Fast path for the common single-object datagram.
+        try:
+            msg = orjson.loads(data.rstrip(b"\x00"))
+            if isinstance(msg, dict):
+                return [msg], []
+        except orjson.JSONDecodeError:
+            pass
+
+    messages = []
+    errors = []
+    text = data.decode("utf-8", errors="replace")
+    end = len(text)
+    pos = 0
+    while True:
+        while pos < end and text[pos] in _SKIPPED:
+            pos += 1
+        if pos >= end:
+            break
+        try:
+            msg, next_pos = _DECODER.raw_decode(text, pos)
+        except ValueError as e:
+            errors.append((pos, str(e)))
+            # Resume at next frame boundary, or at next object if truncated
+            # frame runs straight into the following one.
+            boundary = text.find(_BOUNDARY, pos)
+            if boundary >= 0:
+                pos = boundary + 1
+                continue
+            pos = text.find("{", pos + 1)
+            if pos < 0:
+                break
+            continue
+        if isinstance(msg, dict):
+            messages.append(msg)
+        else:
+            errors.append((pos, "Not an object"))
+        pos = next_pos
+    return messages, errors
@@ -0,0 +1,81 @@
+"""SID-indexed registry of gateway's sub-devices."""
+
+
+class SubDevice:
+    """What is known about single sub-device."""
+
+    __slots__ = ("sid", "model", "last_seen", "voltage", "lqi", "entities", "configured", "discovered")
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.model = None
+        self.last_seen = None
+        self.voltage = None
+        self.lqi = None
+        # Entity IDs representing this device.
+        self.entities = set()
+        # True if device was set up from configuration.
+        self.configured = False
+        # True once entities were created for it by discovery.
+        self.discovered = False
+
+    def as_dict(self):
+        return {
+            "sid": self.sid,
+            "model": self.model,
+            "last_seen": self.last_seen.isoformat() if self.last_seen is not None else None,
+            "voltage": self.voltage,
+            "lqi": self.lqi,
+            "entities": sorted(self.entities),
+        }
+
+
+class SubDeviceRegistry:
+    """Sub-devices of a gateway populated from config and observed traffic."""
+
+    def __init__(self):
+        self._devices = {}
+
+    def __iter__(self):
+        return iter(self._devices.values())
+
+    def __contains__(self, sid):
+        return sid in self._devices
+
+    def get(self, sid):
+        return self._devices.get(sid)
+
+    def configure(self, sid):
+        """Mark device as configured. Safe to call repeatedly."""
+        device = self._device(sid)
+        device.configured = True
+        return device
+
+    def seen(self, sid, model, now=None):
+        """Record device's traffic. Without `now` only model is recorded."""
+        device = self._devices.get(sid)
+        if device is None:
+            device = self._device(sid)
+        if model is not None:
+            device.model = model
+        if now is not None:
+            device.last_seen = now
+        return device
+
+    def attach(self, sid, entity_id):
+        self._device(sid).entities.add(entity_id)
+
+    def detach(self, sid, entity_id):
+        device = self._devices.get(sid)
+        if device is not None:
+            device.entities.discard(entity_id)
+
+    def unconfigured(self):
+        """Return devices seen in traffic but not configured."""
+        return [device for device in self._devices.values() if not device.configured]
+
+    def _device(self, sid):
+        device = self._devices.get(sid)
+        if device is None:
+            device = self._devices[sid] = SubDevice(sid)
+        return device
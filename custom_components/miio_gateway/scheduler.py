@@ -0,0 +1,78 @@
+"""Expiry of momentary states driven by single loop timer."""
+import heapq
+from itertools import count
+
+
+class ExpiryScheduler:
+    """Heap of per-key deadlines served by one `call_at` timer. Event loop only.
+
+    Rescheduling a key leaves its old heap entry behind; stale entries are
+    skipped when popped and dropped by compaction when they pile up.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        # [(deadline, seq, key)]
+        self._heap = []
+        # key -> (deadline, seq, callback) of its live entry
+        self._entries = {}
+        self._seq = count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, key, delay, callback):
+        """Call `callback()` after `delay` seconds unless rescheduled or cancelled."""
+        deadline = self._loop.time() + delay
+        seq = next(self._seq)
+        self._entries[key] = (deadline, seq, callback)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._compact()
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._arm(deadline)
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._timer_deadline = None
+        self._heap.clear()
+        self._entries.clear()
+
+    def _arm(self, deadline):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_at(deadline, self._expire)
+        self._timer_deadline = deadline
+
+    def _expire(self):
+        """Fire due callbacks and re-arm for the next live deadline."""
+        self._timer = None
+        self._timer_deadline = None
+        now = self._loop.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != seq:
+                # Cancelled or rescheduled.
+                continue
+            del self._entries[key]
+            entry[2]()
+        while heap:
+            deadline, seq, key = heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                self._arm(deadline)
+                break
+            heapq.heappop(heap)
+
+    def _compact(self):
+        self._heap = [(deadline, seq, key) for key, (deadline, seq, callback) in self._entries.items()]
+        heapq.heapify(self._heap)
@@ -4,31 +4,74 @@ from homeassistant.const import (
     TEMP_CELSIUS, DEVICE_CLASS_ILLUMINANCE, DEVICE_CLASS_TEMPERATURE, DEVICE_CLASS_HUMIDITY, DEVICE_CLASS_PRESSURE)
 from homeassistant.components.sensor import (
     DEVICE_CLASSES)
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import Entity
 
-from . import DOMAIN, CONF_DATA_DOMAIN, CONF_SENSOR_SID, CONF_SENSOR_CLASS, CONF_SENSOR_NAME, CONF_SENSOR_RESTORE, XiaomiGwDevice
+from . import DOMAIN, CONF_DATA_DOMAIN, CONF_SENSOR_SID, CONF_SENSOR_CLASS, CONF_SENSOR_NAME, CONF_SENSOR_RESTORE, \
+    CONF_SENSOR_PUBLISH, CONF_SENSOR_PUBLISH_INTERVAL, CONF_SENSOR_PUBLISH_THRESHOLD, CONF_SENSOR_HISTORY, \
+    DEFAULT_PUBLISH_INTERVAL, DEFAULT_PUBLISH_THRESHOLD, \
+    SIGNAL_DEVICE_DISCOVERED, XiaomiGwDevice
+from .series import PUBLISH_RAW, Publisher, SampleRing
+from .values import DeviceValues, decode_values
+
+try:
+    from homeassistant.helpers.entity import EntityCategory
+    ENTITY_CATEGORY_DIAGNOSTIC = EntityCategory.DIAGNOSTIC
+except ImportError:
+    ENTITY_CATEGORY_DIAGNOSTIC = "diagnostic"
 
 _LOGGER = logging.getLogger(__name__)
 
+ATTR_RECENT_MIN = "recent_min"
+ATTR_RECENT_MAX = "recent_max"
+ATTR_RECENT_MEAN = "recent_mean"
+ATTR_RECENT_SAMPLES = "recent_samples"
+
 SENSOR_TYPES = {
-    DEVICE_CLASS_ILLUMINANCE: {"unit_of_measurement": "lm", "icon": "mdi:white-balance-sunny"},
-    DEVICE_CLASS_TEMPERATURE: {"unit_of_measurement": TEMP_CELSIUS, "icon": "mdi:thermometer"},
-    DEVICE_CLASS_HUMIDITY: {"unit_of_measurement": "%", "icon": "mdi:water-percent"},
-    DEVICE_CLASS_PRESSURE: {"unit_of_measurement": "hPa", "icon": "mdi:weather-windy"},
+    DEVICE_CLASS_ILLUMINANCE: {"unit_of_measurement": "lm", "icon": "mdi:white-balance-sunny", "param": "illumination"},
+    DEVICE_CLASS_TEMPERATURE: {"unit_of_measurement": TEMP_CELSIUS, "icon": "mdi:thermometer", "param": "temperature"},
+    DEVICE_CLASS_HUMIDITY: {"unit_of_measurement": "%", "icon": "mdi:water-percent", "param": "humidity"},
+    DEVICE_CLASS_PRESSURE: {"unit_of_measurement": "hPa", "icon": "mdi:weather-windy", "param": "pressure"},
 }
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+# Gateway link metrics exposed as diagnostic sensors; histograms show p99.
+METRIC_SENSORS = {
+    "packets_in": {"unit_of_measurement": "packets", "icon": "mdi:download-network"},
+    "packets_out": {"unit_of_measurement": "packets", "icon": "mdi:upload-network"},
+    "decode_errors": {"unit_of_measurement": "errors", "icon": "mdi:alert-circle"},
+    "unknown_methods": {"unit_of_measurement": "messages", "icon": "mdi:help-circle"},
+    "send_queue_depth": {"unit_of_measurement": "commands", "icon": "mdi:tray-full"},
+    "send_queue_dropped": {"unit_of_measurement": "commands", "icon": "mdi:tray-remove"},
+    "send_queue_wait_avg_ms": {"unit_of_measurement": "ms", "icon": "mdi:timer"},
+    "send_queue_wait_max_ms": {"unit_of_measurement": "ms", "icon": "mdi:timer"},
+    "pending_requests": {"unit_of_measurement": "requests", "icon": "mdi:timer-sand"},
+    "ping_rtt_ms": {"unit_of_measurement": "ms", "icon": "mdi:lan-connect"},
+    "ping_loss": {"icon": "mdi:lan-disconnect"},
+    "prop_cache_hits": {"unit_of_measurement": "reads", "icon": "mdi:cached"},
+    "prop_cache_misses": {"unit_of_measurement": "reads", "icon": "mdi:cached"},
+    "reconnects": {"unit_of_measurement": "reconnects", "icon": "mdi:lan-pending"},
+    "duplicates_suppressed": {"unit_of_measurement": "messages", "icon": "mdi:content-duplicate"},
+    "dispatch": {"unit_of_measurement": "ms", "icon": "mdi:timer", "histogram": True},
+    "request": {"unit_of_measurement": "ms", "icon": "mdi:timer", "histogram": True},
+}
+
+async def async_setup_entry(hass, entry, async_add_entities):
     _LOGGER.info("Setting up sensors")
 
     # Make a list of default + custom device classes
     all_device_classes = DEVICE_CLASSES
 
-    gateway = hass.data[DOMAIN]
     entities = []
 
+    gateway = hass.data[DOMAIN][entry.entry_id]
+
     # Gateways's illuminace sensor
-    entities.append(XiaomiGwSensor(gateway, DEVICE_CLASS_ILLUMINANCE, "miio.gateway", "Gateway Illuminance Sensor", False))
+    entities.append(XiaomiGwSensor(
+        gateway, DEVICE_CLASS_ILLUMINANCE, "miio.gateway", "Gateway Illuminance Sensor", False,
+        gateway.illuminance_options))
 
-    for cfg in hass.data[CONF_DATA_DOMAIN]:
+    for cfg in hass.data[CONF_DATA_DOMAIN][gateway.unique_id()]:
         if not cfg:
             cfg = {}
 
@@ -43,23 +86,71 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         gateway.append_known_sid(sid)
 
         if device_class in all_device_classes:
-            _LOGGER.info("Registering " + str(device_class) + " sid " + str(sid) + " as sensor")
-            entities.append(XiaomiGwSensor(gateway, device_class, sid, name, restore))
+            _LOGGER.info("Registering %s sid %s as sensor", device_class, sid)
+            entities.append(XiaomiGwSensor(gateway, device_class, sid, name, restore, cfg))
 
-    if not entities:
-        _LOGGER.info("No sensors configured")
-        return False
+    if gateway.metrics.enabled:
+        for metric in METRIC_SENSORS:
+            entities.append(XiaomiGwMetricSensor(gateway, metric))
 
-    add_entities(entities)
-    return True
+    @callback
+    def device_discovered(discovered_gateway, sid, kinds):
+        if discovered_gateway is not gateway:
+            return
+        discovered = [XiaomiGwSensor(gateway, device_class, sid, None, False)
+                      for platform, device_class in kinds if platform == "sensor"]
+        if discovered:
+            _LOGGER.info("Adding discovered sid %s as sensor", sid)
+            async_add_entities(discovered)
+    entry.async_on_unload(async_dispatcher_connect(hass, SIGNAL_DEVICE_DISCOVERED, device_discovered))
+
+    async_add_entities(entities)
 
 class XiaomiGwSensor(XiaomiGwDevice):
 
-    def __init__(self, gw, device_class, sid, name, restore):
+    def __init__(self, gw, device_class, sid, name, restore, options=None):
         XiaomiGwDevice.__init__(self, gw, "sensor", device_class, sid, name, restore)
 
         self._device_class = device_class
 
+        # Only get values this sensor shows.
+        sensor_type = SENSOR_TYPES.get(device_class)
+        self._value_field = None
+        if sensor_type is not None:
+            self._params_keys = [sensor_type.get("param")]
+            self._value_field = sensor_type.get("param")
+
+        # Readings go to state as they come unless publish option says otherwise.
+        options = options or {}
+        self._publisher = None
+        if options.get(CONF_SENSOR_PUBLISH, PUBLISH_RAW) != PUBLISH_RAW:
+            self._publisher = Publisher(
+                options[CONF_SENSOR_PUBLISH],
+                options.get(CONF_SENSOR_PUBLISH_INTERVAL, DEFAULT_PUBLISH_INTERVAL).total_seconds(),
+                options.get(CONF_SENSOR_PUBLISH_THRESHOLD, DEFAULT_PUBLISH_THRESHOLD))
+        self._flush_scheduled = False
+        # Recent readings, shown as attributes.
+        self._history = None
+        if options.get(CONF_SENSOR_HISTORY):
+            self._history = SampleRing(options[CONF_SENSOR_HISTORY])
+
+    async def async_will_remove_from_hass(self):
+        await super().async_will_remove_from_hass()
+        self._gw.scheduler.cancel(self)
+
+    @property
+    def extra_state_attributes(self):
+        attrs = super().extra_state_attributes
+        if self._history is not None:
+            recent_min, recent_max, recent_mean = self._history.stats()
+            attrs.update({
+                ATTR_RECENT_MIN: recent_min,
+                ATTR_RECENT_MAX: recent_max,
+                ATTR_RECENT_MEAN: round(recent_mean, 2) if recent_mean is not None else None,
+                ATTR_RECENT_SAMPLES: self._history.count,
+            })
+        return attrs
+
     @property
     def state(self):
         return self._state
@@ -83,29 +174,88 @@ class XiaomiGwSensor(XiaomiGwDevice):
             return None
 
     def parse_incoming_data(self, model, sid, event, params):
-        
-        if self._device_class == DEVICE_CLASS_ILLUMINANCE:
-            illumination = params.get("illumination")
-            if illumination is not None:
-                self._state = illumination
-                return True
-
-        elif self._device_class == DEVICE_CLASS_TEMPERATURE:
-            temperature = params.get("temperature")
-            if temperature is not None:
-                self._state = round(temperature/100, 1)
-                return True
-
-        elif self._device_class == DEVICE_CLASS_HUMIDITY:
-            humidity = params.get("humidity")
-            if humidity is not None:
-                self._state = round(humidity/100, 1)
-                return True
-
-        elif self._device_class == DEVICE_CLASS_PRESSURE:
-            pressure = params.get("pressure")
-            if pressure is not None:
-                self._state = round(pressure/100, 1)
-                return True
-
-        return False
+        """Take own field of DeviceValues decoded by gateway."""
+        if self._value_field is None:
+            return False
+        if not isinstance(params, DeviceValues):
+            # Values carried by event.* message.
+            params = decode_values(params)
+        value = getattr(params, self._value_field)
+        if value is None:
+            return False
+        if self._history is not None:
+            self._history.append(value)
+        if self._publisher is not None:
+            now = self.hass.loop.time()
+            value = self._publisher.offer(value, now)
+            if value is None:
+                self._schedule_flush(now)
+                return False
+        self._state = value
+        return True
+
+    def _schedule_flush(self, now):
+        """Publish held back readings when publisher asks for it."""
+        flush_at = self._publisher.next_flush()
+        if flush_at is None or self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        self._gw.scheduler.schedule(self, max(0, flush_at - now), self._flush)
+
+    @callback
+    def _flush(self):
+        self._flush_scheduled = False
+        value = self._publisher.flush(self.hass.loop.time())
+        if value is not None:
+            self._state = value
+            self._schedule_state_write()
+
+
+class XiaomiGwMetricSensor(Entity):
+    """Diagnostic sensor showing single gateway link metric."""
+
+    def __init__(self, gw, metric):
+        self._gw = gw
+        self._metric = metric
+        self._type = METRIC_SENSORS[metric]
+        self._unique_id = "{}_metric_{}".format(gw.unique_id(), metric)
+        self.entity_id = "sensor." + gw.entity_prefix + "miio_gateway_" + metric
+        self._name = "Gateway " + metric.replace("_", " ")
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def unique_id(self) -> str:
+        return self._unique_id
+
+    @property
+    def entity_category(self):
+        return ENTITY_CATEGORY_DIAGNOSTIC
+
+    @property
+    def icon(self):
+        return self._type.get("icon")
+
+    @property
+    def unit_of_measurement(self):
+        return self._type.get("unit_of_measurement")
+
+    @property
+    def state(self):
+        if self._type.get("histogram"):
+            return self._histogram_snapshot().get("p99_ms")
+        return self._gw.metrics.value(self._metric)
+
+    @property
+    def extra_state_attributes(self):
+        if self._type.get("histogram"):
+            return self._histogram_snapshot()
+        return None
+
+    def _histogram_snapshot(self):
+        histogram = self._gw.metrics.histograms.get(self._metric)
+        if histogram is None:
+            return {}
+        return histogram.snapshot()
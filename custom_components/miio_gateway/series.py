@@ -0,0 +1,98 @@
+"""Recent sensor readings and policies deciding which of them get published."""
+from array import array
+
+PUBLISH_RAW = "raw"
+PUBLISH_INTERVAL = "interval"
+PUBLISH_THRESHOLD = "threshold"
+PUBLISH_MEAN = "mean"
+PUBLISH_MIN = "min"
+PUBLISH_MAX = "max"
+PUBLISH_MODES = [PUBLISH_RAW, PUBLISH_INTERVAL, PUBLISH_THRESHOLD, PUBLISH_MEAN, PUBLISH_MIN, PUBLISH_MAX]
+AGGREGATE_MODES = [PUBLISH_MEAN, PUBLISH_MIN, PUBLISH_MAX]
+
+
+class SampleRing:
+    """Fixed-size ring of float readings backed by typed array."""
+
+    __slots__ = ("_values", "_next", "count")
+
+    def __init__(self, size):
+        self._values = array("d", bytes(8 * size))
+        self._next = 0
+        self.count = 0
+
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        if self.count < len(self._values):
+            self.count += 1
+
+    def stats(self):
+        """Return (min, max, mean) of held readings, Nones when empty."""
+        if not self.count:
+            return None, None, None
+        values = self._values if self.count == len(self._values) else self._values[:self.count]
+        return min(values), max(values), sum(values) / self.count
+
+
+class Publisher:
+    """Decides when readings of a sensor are published as its state.
+
+    `offer` returns value to publish right away or None. Readings held back
+    are published by `flush` once `next_flush` time comes.
+    """
+
+    def __init__(self, mode, interval, threshold):
+        self._mode = mode
+        self._interval = interval
+        self._threshold = threshold
+        self._last_value = None
+        self._last_time = None
+        # Held back reading (interval) or window accumulators (aggregates).
+        self._pending = None
+        self._count = 0
+        self._total = 0.0
+
+    def offer(self, value, now):
+        mode = self._mode
+        if mode == PUBLISH_RAW:
+            return value
+        if mode == PUBLISH_THRESHOLD:
+            if self._last_value is None or abs(value - self._last_value) >= self._threshold:
+                self._last_value = value
+                return value
+            return None
+        if self._last_time is None or (mode == PUBLISH_INTERVAL and now - self._last_time >= self._interval):
+            # First reading shows up at once, so does first after quiet interval.
+            self._last_time = now
+            self._pending = None
+            return value
+        if mode == PUBLISH_INTERVAL:
+            self._pending = value
+        else:
+            self._count += 1
+            self._total += value
+            if self._pending is None:
+                self._pending = value
+            elif mode == PUBLISH_MIN:
+                self._pending = min(self._pending, value)
+            elif mode == PUBLISH_MAX:
+                self._pending = max(self._pending, value)
+        return None
+
+    def next_flush(self):
+        """Return time of publishing held readings, None if nothing is held."""
+        if self._pending is None:
+            return None
+        return self._last_time + self._interval
+
+    def flush(self, now):
+        """Return value of held readings and start new window."""
+        value = self._pending
+        if value is not None and self._mode == PUBLISH_MEAN:
+            value = round(self._total / self._count, 1)
+        self._pending = None
+        self._count = 0
+        self._total = 0.0
+        self._last_time = now
+        return value
@@ -0,0 +1,95 @@
+"""Warm-start snapshot of last known values of gateway entities and devices."""
+import logging
+from datetime import datetime, timedelta
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
+from homeassistant.util.dt import parse_datetime
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY = "miio_gateway.snapshot"
+STORAGE_VERSION = 1
+SNAPSHOT_INTERVAL = timedelta(minutes=5)
+
+
+class XiaomiGwSnapshot:
+    """Single storage file read once at startup and rewritten periodically.
+
+    Entities and gateways put their values back from it when added, live
+    data overwrites them as it arrives.
+    """
+
+    def __init__(self, hass):
+        self.hass = hass
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        # Loaded records: {"entities": {unique_id: {...}}, "devices": {gateway: {sid: {...}}}}
+        self._data = {"entities": {}, "devices": {}}
+        # unique_id -> entity, gateway unique_id -> gateway
+        self._entities = {}
+        self._gateways = {}
+
+    async def async_start(self):
+        """Load snapshot and start saving it."""
+        data = await self._store.async_load()
+        if data:
+            self._data["entities"].update(data.get("entities", {}))
+            self._data["devices"].update(data.get("devices", {}))
+        async_track_time_interval(self.hass, self._async_save, SNAPSHOT_INTERVAL)
+        self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._async_save)
+
+    def restore_entity(self, entity):
+        """Put entity's last known values back and keep it in next snapshots."""
+        self._entities[entity.unique_id] = entity
+        record = self._data["entities"].get(entity.unique_id)
+        if record is not None:
+            entity.snapshot_restore(record)
+
+    def forget_entity(self, entity):
+        if self._entities.pop(entity.unique_id, None) is entity:
+            self._data["entities"][entity.unique_id] = entity.snapshot_record()
+
+    def restore_gateway(self, gateway):
+        """Put known devices of gateway back to its registry."""
+        self._gateways[gateway.unique_id()] = gateway
+        for sid, record in self._data["devices"].get(gateway.unique_id(), {}).items():
+            device = gateway.registry.seen(sid, record.get("model"), _parse(record.get("last_seen")))
+            device.voltage = record.get("voltage")
+            device.lqi = record.get("lqi")
+
+    def forget_gateway(self, gateway):
+        if self._gateways.pop(gateway.unique_id(), None) is gateway:
+            self._data["devices"][gateway.unique_id()] = _devices_record(gateway)
+
+    async def _async_save(self, *args):
+        entities = self._data["entities"]
+        for unique_id, entity in self._entities.items():
+            entities[unique_id] = entity.snapshot_record()
+        devices = self._data["devices"]
+        for unique_id, gateway in self._gateways.items():
+            devices[unique_id] = _devices_record(gateway)
+        await self._store.async_save(self._data)
+
+
+def _devices_record(gateway):
+    return {
+        device.sid: {
+            "model": device.model,
+            "last_seen": device.last_seen.isoformat() if device.last_seen is not None else None,
+            "voltage": device.voltage,
+            "lqi": device.lqi,
+        }
+        for device in gateway.registry
+    }
+
+
+def serialize(value):
+    """Make value JSON friendly."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _parse(value):
+    return parse_datetime(value) if value else None
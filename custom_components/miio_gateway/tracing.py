@@ -0,0 +1,71 @@
+"""Bounded in-memory trace of frames exchanged with the gateway."""
+from collections import OrderedDict, deque
+from time import perf_counter, time
+
+DIRECTION_IN = "in"
+DIRECTION_OUT = "out"
+
+# Sent request times kept for matching their results.
+MAX_TRACKED_REQUESTS = 64
+
+
+class FrameTracer:
+    """Ring buffer of structured frame records."""
+
+    enabled = True
+
+    def __init__(self, size):
+        self._frames = deque(maxlen=size)
+        # miio id -> perf_counter of request sent
+        self._sent = OrderedDict()
+
+    def sent(self, msg, size):
+        """Record outgoing message."""
+        miio_id = msg.get("id")
+        if miio_id is not None:
+            self._sent[miio_id] = perf_counter()
+            while len(self._sent) > MAX_TRACKED_REQUESTS:
+                self._sent.popitem(last=False)
+        self._record(DIRECTION_OUT, miio_id, msg.get("sid"), msg.get("method"), size, None)
+
+    def received(self, msg, size):
+        """Record incoming message. Results get latency of their request."""
+        miio_id = msg.get("id")
+        latency = None
+        if "method" not in msg and miio_id is not None:
+            sent = self._sent.pop(miio_id, None)
+            if sent is not None:
+                latency = round(1000 * (perf_counter() - sent), 3)
+        self._record(DIRECTION_IN, miio_id, msg.get("sid"), msg.get("method"), size, latency)
+
+    def last(self, count):
+        """Return last `count` records, oldest first."""
+        if count >= len(self._frames):
+            return list(self._frames)
+        return list(self._frames)[-count:]
+
+    def _record(self, direction, miio_id, sid, method, size, latency):
+        self._frames.append({
+            "time": time(),
+            "direction": direction,
+            "id": miio_id,
+            "sid": sid,
+            "method": method,
+            "size": size,
+            "latency_ms": latency,
+        })
+
+
+class NullTracer:
+    """Tracer used when tracing is disabled. Does nothing."""
+
+    enabled = False
+
+    def sent(self, msg, size):
+        pass
+
+    def received(self, msg, size):
+        pass
+
+    def last(self, count):
+        return []
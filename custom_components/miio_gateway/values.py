@@ -0,0 +1,45 @@
+"""Typed values of sub-device messages, decoded once per message."""
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Params keys reported in hundredths.
+SCALED_KEYS = ("temperature", "humidity", "pressure")
+
+
+class DeviceValues(dict):
+    """Params dict of `props`/`_otc.log` message with its known values decoded.
+
+    Stays a plain dict for subscribers reading raw params; values the
+    message doesn't carry are None.
+    """
+
+    __slots__ = ("temperature", "humidity", "pressure", "illumination", "voltage", "lqi")
+
+
+def decode_values(params):
+    """Decode params once into DeviceValues shared by all subscribers."""
+    values = DeviceValues(params)
+    for key in SCALED_KEYS:
+        setattr(values, key, _scaled(params, key))
+    values.illumination = params.get("illumination")
+    zigbee_data = params.get("subdev_zigbee")
+    if isinstance(zigbee_data, dict):
+        values.voltage = zigbee_data.get("voltage")
+        values.lqi = zigbee_data.get("lqi")
+    else:
+        values.voltage = None
+        values.lqi = None
+    return values
+
+
+def _scaled(params, key):
+    """Return value of key in units, None if missing or malformed."""
+    value = params.get(key)
+    if value is None:
+        return None
+    try:
+        return round(float(value) / 100, 1)
+    except (TypeError, ValueError):
+        _LOGGER.warning("Malformed %s value: %r", key, value)
+        return None